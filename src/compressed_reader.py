@@ -0,0 +1,93 @@
+"""
+    Streaming reader for compressed last.fm dumps.
+
+    The raw dumps are kept as .gz, .bz2 or .xz files. read_compressed_lines() decompresses them in a background thread
+    that feeds blocks of bytes to the parser through a bounded queue, so there is no decompress-to-disk step and the
+    decompression (which releases the GIL in zlib, bz2 and lzma) runs at the same time as the parsing. The queue size
+    caps how far the decompression can run ahead, so memory stays bounded.
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+import queue
+import threading
+
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def is_compressed(file_name):
+    """
+        :return: True if the file has the extension of a compression format read_compressed_lines() can read
+        :rtype: bool
+    """
+
+    return os.path.splitext(file_name)[1] in COMPRESSED_OPENERS
+
+
+def read_compressed_lines(file_name, encoding="utf8", block_size=1 << 20, queue_size=16):
+    """
+        Reads the lines of a compressed text file while it is decompressed in another thread
+
+        :param file_name: the path of a .gz, .bz2 or .xz file
+        :type file_name: str
+
+        :param block_size: the number of decompressed bytes in each block passed to the parser
+        :type block_size: int
+
+        :param queue_size: the number of blocks that can wait in the queue
+        :type queue_size: int
+
+        :return: generator of the decoded lines, each ending with a newline except maybe the last one
+        :rtype: generator
+    """
+
+    opener = COMPRESSED_OPENERS[os.path.splitext(file_name)[1]]
+    blocks = queue.Queue(queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        # give up when the reader has stopped, otherwise a full queue would block this thread forever
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def decompress():
+        try:
+            with opener(file_name, 'rb') as f:
+                while not stop.is_set():
+                    block = f.read(block_size)
+                    put(block)
+                    # an empty block tells the reader the file is done
+                    if not block:
+                        return
+        except Exception as error:
+            put(error)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+
+    remainder = b''
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+
+            # the last piece may be part of a line that continues in the next block
+            lines = (remainder + block).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line.decode(encoding) + '\n'
+
+        if remainder:
+            yield remainder.decode(encoding)
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,516 @@
+"""
+    Country-artist graphs made from the per year country_artist dictionaries.
+
+    top_artists() links every country to its most played artists. The country nodes have a 'country' attribute and
+    the artist nodes an 'artist' attribute, and the edge weight is the weight of the year dictionary it is given: the
+    play count, the number of listeners or the normalized plays.
+    top_artists_graphs() makes the graphs of several years at once, one year per process.
+
+    A networkx.Graph keeps a dictionary for every node and edge. CountryArtistGraph keeps the same graph in a few CSR
+    arrays (each country's artist ids and edge weights) and only makes a networkx.Graph when it is drawn, see
+    compact_top_artists().
+
+    TopArtistsView answers the same questions straight from a RankingIndex without making any graph, for code that
+    only reads the neighbors of a few countries. threshold_artists_view() makes the same kind of view with the artists
+    above a play count or play share threshold instead of a fixed number of top artists.
+"""
+
+from multiprocessing import Pool
+
+import networkx as nx
+import numpy as np
+
+from top_k import top_k_dict
+from vocabulary import COUNT_TYPE, ID_TYPE, Vocabulary
+
+
+def top_artists(year_dict, top_number, ranking=None):
+    """
+        Makes a graph that links every country to its top_number most played artists
+
+        Countries with fewer than top_number artists are left out.
+
+        :param year_dict: dictionary[country][artist] = weight for one year, the artists are ranked and the edges
+                          weighted by it. That is the play count of YYYY_country_artist, the number of listeners of
+                          YYYY_country_listeners or the normalized plays of e.g. YYYY_country_artist_share.
+        :type year_dict: dict
+
+        :param top_number: the number of artists linked to each country
+        :type top_number: int
+
+        :param ranking: a RankingIndex of the same year and weights, the top artists are then a slice of it instead of
+                        a scan of the dictionary
+        :type ranking: RankingIndex
+
+        :rtype: networkx.Graph
+    """
+
+    # create graph to represent trends for given year
+    G = nx.Graph()
+
+    # loop through each artist in the dictionary
+    for country in year_dict:
+        # make sure the country has enough top artists, skip it otherwise
+        if len(year_dict[country]) < top_number:
+            continue
+
+        # create country node & add it
+        G.add_node(country, country=True)
+
+        # get top artists for current country
+        if ranking is None:
+            tops = [(top, year_dict[country][top]) for top in top_k_dict(year_dict[country], top_number)]
+        else:
+            tops = ranking.top(country, top_number)
+
+        for top, plays in tops:
+            # create node for the top artist and make a conenction b/n it and the country
+            G.add_node(top, artist=True)
+            G.add_edge(country, top, weight=plays)
+
+    return G
+
+
+class CountryArtistGraph:
+    """
+        A top artists graph stored as CSR arrays instead of networkx dictionaries
+
+        Country i links to the artist ids artist_ids[pointers[i]:pointers[i + 1]], ranked from most to least played,
+        and the edge weights are at the same positions in weights. The artist nodes are the artists with at least one
+        edge. It has the read only part of the networkx.Graph interface the notebook and similarity.py use, and
+        to_networkx() makes a networkx.Graph for drawing or changing the graph.
+
+        Unlike networkx, a country and an artist with the same name (e.g. the band Japan) are two nodes here.
+        neighbors() and node_attributes() give the country for such a name.
+    """
+
+    def __init__(self, countries, artists, pointers, artist_ids, weights):
+        """
+            :param countries: the country of every row
+            :type countries: list
+
+            :param artists: the vocabulary the artist ids come from, it can be shared by several graphs
+            :type artists: Vocabulary
+
+            :param pointers: the start of every country's edges, with the end of the last one added
+            :type pointers: numpy.ndarray
+        """
+
+        self.countries = countries
+        self.artists = artists
+        self.pointers = pointers
+        self.artist_ids = artist_ids
+        self.weights = weights
+
+        self.country_index = {country: i for i, country in enumerate(countries)}
+        self.artist_nodes = np.unique(artist_ids)
+
+    def __len__(self):
+        return len(self.countries) + len(self.artist_nodes)
+
+    def __iter__(self):
+        return iter(self.nodes())
+
+    def __contains__(self, node):
+        return self.has_node(node)
+
+    def has_node(self, node):
+        return node in self.country_index or self.has_artist(node)
+
+    def has_artist(self, artist):
+        artist_id = self.artists.get(artist)
+        position = np.searchsorted(self.artist_nodes, artist_id)
+        return artist_id >= 0 and position < len(self.artist_nodes) and self.artist_nodes[position] == artist_id
+
+    def nodes(self, data=False):
+        """
+            :return: the countries then the artists, as (node, attributes) pairs if data is True
+            :rtype: list
+        """
+
+        nodes = self.countries + [self.artists.word(i) for i in self.artist_nodes.tolist()]
+        if data:
+            return [(node, self.node_attributes(node)) for node in nodes]
+        return nodes
+
+    def node_attributes(self, node):
+        """
+            :return: {'country': True} or {'artist': True}, the same attributes top_artists() gives the nodes
+            :rtype: dict
+        """
+
+        if node in self.country_index:
+            return {'country': True}
+        if self.has_artist(node):
+            return {'artist': True}
+        raise KeyError(node)
+
+    def number_of_edges(self):
+        return len(self.artist_ids)
+
+    def edges(self, data=False):
+        """
+            :return: the (country, artist) edges, as (country, artist, {'weight': weight}) if data is True
+            :rtype: list
+        """
+
+        edges = list()
+        for i, country in enumerate(self.countries):
+            start, end = self.pointers[i], self.pointers[i + 1]
+            for artist_id, weight in zip(self.artist_ids[start:end].tolist(), self.weights[start:end].tolist()):
+                if data:
+                    edges.append((country, self.artists.word(artist_id), {'weight': weight}))
+                else:
+                    edges.append((country, self.artists.word(artist_id)))
+
+        return edges
+
+    def neighbors(self, node):
+        """
+            :return: the artists of a country from most to least played, or the countries an artist is linked to
+            :rtype: list
+        """
+
+        if node in self.country_index:
+            i = self.country_index[node]
+            return [self.artists.word(artist_id)
+                    for artist_id in self.artist_ids[self.pointers[i]:self.pointers[i + 1]].tolist()]
+
+        if not self.has_artist(node):
+            raise KeyError(node)
+
+        rows = np.searchsorted(self.pointers, np.flatnonzero(self.artist_ids == self.artists.get(node)), 'right') - 1
+        return [self.countries[i] for i in rows.tolist()]
+
+    def degree(self, node):
+        return len(self.neighbors(node))
+
+    def has_edge(self, u, v):
+        return self.edge_position(u, v) >= 0
+
+    def edge_weight(self, u, v):
+        """
+            :return: the weight of the edge between a country and an artist, in either order
+            :rtype: int
+        """
+
+        position = self.edge_position(u, v)
+        if position < 0:
+            raise KeyError((u, v))
+        return self.weights[position].item()
+
+    def edge_position(self, u, v):
+        """
+            :return: the position of the edge in the arrays, or -1 if there is no edge between u and v
+            :rtype: int
+        """
+
+        for country, artist in ((u, v), (v, u)):
+            if country in self.country_index and self.has_artist(artist):
+                i = self.country_index[country]
+                positions = np.flatnonzero(self.artist_ids[self.pointers[i]:self.pointers[i + 1]] ==
+                                           self.artists.get(artist))
+                if len(positions):
+                    return self.pointers[i] + positions[0]
+
+        return -1
+
+    def subgraph(self, nodes):
+        """
+            Gets the graph of the given nodes and the edges between them
+
+            Artists in nodes without an edge to one of the countries in nodes aren't kept, the artist nodes are always
+            the artists with an edge.
+
+            :param nodes: the countries and artists to keep
+            :type nodes: iterable
+
+            :rtype: CountryArtistGraph
+        """
+
+        nodes = set(nodes)
+        kept_artists = np.array(sorted(self.artists.get(node) for node in nodes if self.has_artist(node)),
+                                dtype=ID_TYPE)
+
+        countries = list()
+        rows = list()
+        for i, country in enumerate(self.countries):
+            if country in nodes:
+                start, end = self.pointers[i], self.pointers[i + 1]
+                countries.append(country)
+                rows.append(start + np.flatnonzero(np.isin(self.artist_ids[start:end], kept_artists)))
+
+        positions = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        pointers = np.concatenate(([0], np.cumsum([len(row) for row in rows]))).astype(np.int64)
+        return CountryArtistGraph(countries, self.artists, pointers, self.artist_ids[positions],
+                                  self.weights[positions])
+
+    def to_networkx(self):
+        """
+            :return: the same graph as top_artists() would make
+            :rtype: networkx.Graph
+        """
+
+        G = nx.Graph()
+        for country, artist, data in self.edges(data=True):
+            G.add_node(country, country=True)
+            G.add_node(artist, artist=True)
+            G.add_edge(country, artist, **data)
+
+        # countries without edges
+        G.add_nodes_from(self.countries, country=True)
+        return G
+
+
+def compact_top_artists(year_dict, top_number, ranking=None):
+    """
+        Makes the same graph as top_artists() as a CountryArtistGraph, without networkx
+
+        :param year_dict: dictionary[country][artist] = weight for one year, see top_artists()
+        :type year_dict: dict
+
+        :param ranking: a RankingIndex of the same year and weights, its artist vocabulary is used by the graph
+        :type ranking: RankingIndex
+
+        :rtype: CountryArtistGraph
+    """
+
+    if ranking is not None:
+        return TopArtistsView(ranking, top_number).to_compact()
+
+    artists = Vocabulary()
+    countries = list()
+    artist_ids = list()
+    weights = list()
+    for country in year_dict:
+        # make sure the country has enough top artists, skip it otherwise
+        if len(year_dict[country]) < top_number:
+            continue
+
+        countries.append(country)
+        tops = top_k_dict(year_dict[country], top_number)
+        artist_ids.append(np.array([artists.id(top) for top in tops], dtype=ID_TYPE))
+        weights.append(np.array([year_dict[country][top] for top in tops]))
+
+    pointers = np.concatenate(([0], np.cumsum([len(ids) for ids in artist_ids]))).astype(np.int64)
+    if not countries:
+        return CountryArtistGraph(countries, artists, pointers, np.empty(0, dtype=ID_TYPE),
+                                  np.empty(0, dtype=COUNT_TYPE))
+
+    return CountryArtistGraph(countries, artists, pointers, np.concatenate(artist_ids).astype(ID_TYPE),
+                              np.concatenate(weights))
+
+
+class RankingView:
+    """
+        A read only country-artist graph answered straight from a RankingIndex
+
+        Every country in sizes links to the first sizes[country] artists of its ranking. Nothing is copied: the
+        neighbors of a country are a slice of its ranking, and the countries of every artist are only worked out the
+        first time an artist is asked about. to_networkx() or to_compact() make a graph when one is really needed.
+
+        Like CountryArtistGraph, a country and an artist with the same name are two nodes and the country is given for
+        such a name.
+    """
+
+    def __init__(self, ranking, sizes):
+        """
+            :param ranking: the RankingIndex of one year
+            :type ranking: RankingIndex
+
+            :param sizes: dictionary[country] = the number of artists linked to the country, in the order of the
+                          country nodes
+            :type sizes: dict
+        """
+
+        self.ranking = ranking
+        self.sizes = sizes
+        self.countries = list(sizes)
+        self.country_set = set(self.countries)
+
+        # dictionary[artist_id] = list of countries, made by artist_countries() when first needed
+        self.artist_index = None
+
+    def __len__(self):
+        return len(self.countries) + len(self.artist_countries())
+
+    def __iter__(self):
+        return iter(self.nodes())
+
+    def __contains__(self, node):
+        return self.has_node(node)
+
+    def has_node(self, node):
+        return node in self.country_set or self.has_artist(node)
+
+    def has_artist(self, artist):
+        return self.ranking.artists.get(artist) in self.artist_countries()
+
+    def artist_countries(self):
+        if self.artist_index is None:
+            self.artist_index = dict()
+            for country in self.countries:
+                for artist_id in self.ranking.top_ids(country, self.sizes[country])[0].tolist():
+                    self.artist_index.setdefault(artist_id, list()).append(country)
+
+        return self.artist_index
+
+    def nodes(self, data=False):
+        """
+            :return: the countries then the artists, as (node, attributes) pairs if data is True
+            :rtype: list
+        """
+
+        if data:
+            return ([(country, {'country': True}) for country in self.countries] +
+                    [(self.ranking.artists.word(i), {'artist': True}) for i in self.artist_countries()])
+        return self.countries + [self.ranking.artists.word(i) for i in self.artist_countries()]
+
+    def neighbors(self, node):
+        """
+            :return: the top artists of a country from most to least played, or the countries an artist is linked to
+            :rtype: list
+        """
+
+        if node in self.country_set:
+            return [artist for artist, _ in self.ranking.top(node, self.sizes[node])]
+        if not self.has_artist(node):
+            raise KeyError(node)
+
+        return list(self.artist_countries()[self.ranking.artists.get(node)])
+
+    def degree(self, node):
+        if node in self.country_set:
+            return self.sizes[node]
+        return len(self.neighbors(node))
+
+    def has_edge(self, u, v):
+        try:
+            self.edge_weight(u, v)
+        except KeyError:
+            return False
+        return True
+
+    def edge_weight(self, u, v):
+        """
+            :return: the play count of the artist in the country, in either order
+            :rtype: int
+        """
+
+        for country, artist in ((u, v), (v, u)):
+            if country in self.country_set:
+                artist_ids, counts = self.ranking.top_ids(country, self.sizes[country])
+                positions = np.flatnonzero(artist_ids == self.ranking.artists.get(artist))
+                if len(positions):
+                    return counts[positions[0]].item()
+
+        raise KeyError((u, v))
+
+    def to_compact(self):
+        """
+            :rtype: CountryArtistGraph
+        """
+
+        tops = [self.ranking.top_ids(country, self.sizes[country]) for country in self.countries]
+        pointers = np.concatenate(([0], np.cumsum([len(artist_ids) for artist_ids, _ in tops]))).astype(np.int64)
+
+        if not tops:
+            return CountryArtistGraph([], self.ranking.artists, pointers, np.empty(0, dtype=ID_TYPE),
+                                      np.empty(0, dtype=COUNT_TYPE))
+        return CountryArtistGraph(list(self.countries), self.ranking.artists, pointers,
+                                  np.concatenate([artist_ids for artist_ids, _ in tops]),
+                                  np.concatenate([counts for _, counts in tops]))
+
+    def to_networkx(self):
+        """
+            :return: the same graph as top_artists() would make, which can be changed
+            :rtype: networkx.Graph
+        """
+
+        return self.to_compact().to_networkx()
+
+
+class TopArtistsView(RankingView):
+    """
+        The top artists graph of a RankingIndex: every country with at least top_number artists links to its
+        top_number most played artists, the same graph top_artists() makes
+    """
+
+    def __init__(self, ranking, top_number):
+        RankingView.__init__(self, ranking, {country: top_number for country in ranking
+                                             if ranking.size(country) >= top_number})
+        self.top_number = top_number
+
+
+def threshold_artists_view(ranking, min_count=None, min_share=None):
+    """
+        Links every country to the artists that pass a play threshold instead of a fixed number of top artists
+
+        Countries aren't left out for having few artists, only countries where no artist passes the threshold are.
+        The number of artists of each country is a binary search of its sorted counts, so a sweep over thresholds
+        reuses the same RankingIndex.
+
+        :param ranking: the RankingIndex of one year
+        :type ranking: RankingIndex
+
+        :param min_count: the fewest plays an artist needs in a country
+        :type min_count: int
+
+        :param min_share: the smallest share of the country's plays an artist needs, e.g. 0.01 for 1%
+        :type min_share: float
+
+        :rtype: RankingView
+    """
+
+    if min_count is None and min_share is None:
+        raise ValueError('a threshold needs min_count or min_share')
+
+    sizes = dict()
+    for country in ranking:
+        threshold = 0
+        if min_count is not None:
+            threshold = min_count
+        if min_share is not None:
+            threshold = max(threshold, min_share * ranking.total(country))
+
+        size = ranking.count_at_least(country, threshold)
+        if size > 0:
+            sizes[country] = size
+
+    return RankingView(ranking, sizes)
+
+
+def top_artists_graphs(year_dicts, top_number, processes=1, compact=False):
+    """
+        Makes the top artists graph of every year, each year in its own process
+
+        The years don't depend on each other, so with a process per year all of them take about as long as the
+        largest one.
+
+        :param year_dicts: dictionary[year] = country_artist dictionary for that year
+        :type year_dicts: dict
+
+        :param top_number: the number of artists linked to each country
+        :type top_number: int
+
+        :param processes: the number of processes, 1 makes the graphs in this process
+        :type processes: int
+
+        :param compact: make CountryArtistGraphs instead of networkx graphs, they are also much quicker to send back
+                        from the worker processes
+        :type compact: bool
+
+        :return: dictionary[year] = networkx.Graph or CountryArtistGraph
+        :rtype: dict
+    """
+
+    years = list(year_dicts)
+    make_graph = compact_top_artists if compact else top_artists
+
+    if processes <= 1 or len(years) <= 1:
+        return {year: make_graph(year_dicts[year], top_number) for year in years}
+
+    with Pool(min(processes, len(years))) as pool:
+        graphs = pool.starmap(make_graph, [(year_dicts[year], top_number) for year in years])
+
+    return dict(zip(years, graphs))
@@ -0,0 +1,272 @@
+"""
+    Memory mapped binary files for the dictionaries in data/dictionary.
+
+    A pickle has to be read and turned into Python objects all at once, so opening plays.pkl or a country_artist
+    dictionary costs the same whether one country is needed or all of them. The files made here are opened with mmap
+    and read through numpy views of the file, so only the pages for the rows that are looked up get read.
+
+    Each file holds one 2 level dictionary, dictionary[outer][inner] = count, laid out like a CSR matrix:
+
+        header          magic, number of outer keys, number of inner words, number of entries, value type,
+                        section offsets
+        row_pointers    int64[n_outer + 1], entries of row i are row_pointers[i]:row_pointers[i + 1]
+        inner_ids       int32[n_entries], index into the inner string table, sorted in each row
+        counts          int64[n_entries], or float64[n_entries] when a value is a float (e.g. normalized shares)
+        outer_offsets   int64[n_outer + 1], byte offsets of each outer key in the outer string blob
+        inner_offsets   int64[n_inner + 1], byte offsets of each inner word in the inner string blob
+        outer_blob      utf8 bytes of the outer keys, sorted
+        inner_blob      utf8 bytes of the inner words, sorted
+
+    Both string tables are sorted so a key can be found with a binary search over the mapped offsets. The plays
+    dictionary has an extra year level, so it is stored as one file per year named YYYY_plays.
+"""
+
+import bisect
+import mmap
+import pickle
+import struct
+
+import numpy as np
+
+from paths import dictionary_path
+
+MAGIC = b'LFMTAB02'
+HEADER = struct.Struct('<8s4Q7Q')
+ALIGNMENT = 8
+
+# the value type number in the header is the index in this tuple
+VALUE_TYPES = (np.int64, np.float64)
+
+
+class StringTable:
+    """
+        Read only sorted list of strings stored as an offset array and a utf8 blob
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode('utf8')
+
+    def find(self, word):
+        """
+            Finds the index of a word with a binary search
+
+            :return: the index of the word or -1 if it isn't in the table
+            :rtype: int
+        """
+
+        index = bisect.bisect_left(self, word)
+        if index < len(self) and self[index] == word:
+            return index
+        return -1
+
+
+class MappedTable:
+    """
+        A dictionary[outer][inner] = count read from a memory mapped file
+
+        Looking up an outer key returns a normal dictionary of that row only. The row() method returns the inner ids
+        and counts as numpy arrays that point straight into the file, see close() for what that means for closing it.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(self.map, 0)
+        if header[0] != MAGIC:
+            raise ValueError(path + ' is not a mapped table file')
+
+        number_of_outer, number_of_inner, number_of_entries, value_type = header[1:5]
+        sections = header[5:]
+
+        self.row_pointers = self._array(sections[0], np.int64, number_of_outer + 1)
+        self.inner_ids = self._array(sections[1], np.int32, number_of_entries)
+        self.counts = self._array(sections[2], VALUE_TYPES[value_type], number_of_entries)
+
+        outer_offsets = self._array(sections[3], np.int64, number_of_outer + 1)
+        inner_offsets = self._array(sections[4], np.int64, number_of_inner + 1)
+        buffer = memoryview(self.map)
+        self.outer = StringTable(outer_offsets, buffer[sections[5]:sections[5] + int(outer_offsets[-1])])
+        self.inner = StringTable(inner_offsets, buffer[sections[6]:sections[6] + int(inner_offsets[-1])])
+
+    def _array(self, offset, dtype, length):
+        return np.frombuffer(self.map, dtype=dtype, count=length, offset=offset)
+
+    def __len__(self):
+        return len(self.outer)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return self.outer.find(key) >= 0
+
+    def __getitem__(self, key):
+        inner_ids, counts = self.row(key)
+        return dict(zip([self.inner[i] for i in inner_ids.tolist()], counts.tolist()))
+
+    def keys(self):
+        return [self.outer[i] for i in range(len(self.outer))]
+
+    def row(self, key):
+        """
+            Gets the inner word ids and counts of one outer key without copying them
+
+            The arrays are views of the mapped file. They stay valid after close(), the file is only unmapped once
+            the last of them is freed. Copy them (e.g. counts.copy()) to keep them without keeping the map.
+
+            :return: (inner_ids, counts) arrays
+            :rtype: tuple
+        """
+
+        index = self.outer.find(key)
+        if index < 0:
+            raise KeyError(key)
+
+        start, end = self.row_pointers[index], self.row_pointers[index + 1]
+        return self.inner_ids[start:end], self.counts[start:end]
+
+    def to_dict(self):
+        """
+            Reads the whole file into a dictionary[outer][inner] = count
+        """
+
+        return {key: self[key] for key in self.keys()}
+
+    def close(self):
+        # drop the numpy views first, mmap can't close while they still point into it
+        self.row_pointers = self.inner_ids = self.counts = None
+        self.outer = self.inner = None
+        try:
+            self.map.close()
+        except BufferError:
+            # arrays from row() still point into the map, it is unmapped when the last of them is freed
+            pass
+        self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_table(path, nested):
+    """
+        Writes a dictionary[outer][inner] = count to a mapped table file
+
+        The counts are stored as int64, or as float64 if any of them is a float so normalized values aren't truncated.
+
+        :param path: the file to write
+        :type path: str
+
+        :param nested: the 2 level dictionary to store
+        :type nested: dict
+    """
+
+    outer_words = sorted(nested)
+    inner_words = sorted({inner for outer in nested for inner in nested[outer]})
+    inner_index = {word: i for i, word in enumerate(inner_words)}
+
+    row_pointers = np.zeros(len(outer_words) + 1, dtype=np.int64)
+    inner_ids = list()
+    counts = list()
+    for i, outer in enumerate(outer_words):
+        row = sorted((inner_index[inner], count) for inner, count in nested[outer].items())
+        inner_ids.extend(pair[0] for pair in row)
+        counts.extend(pair[1] for pair in row)
+        row_pointers[i + 1] = len(inner_ids)
+
+    value_type = 1 if any(isinstance(count, (float, np.floating)) for count in counts) else 0
+
+    outer_offsets, outer_blob = _string_section(outer_words)
+    inner_offsets, inner_blob = _string_section(inner_words)
+
+    sections = [row_pointers.tobytes(),
+                np.array(inner_ids, dtype=np.int32).tobytes(),
+                np.array(counts, dtype=VALUE_TYPES[value_type]).tobytes(),
+                outer_offsets.tobytes(),
+                inner_offsets.tobytes(),
+                outer_blob,
+                inner_blob]
+
+    # place every section on an 8 byte boundary after the header
+    offsets = list()
+    position = HEADER.size
+    for section in sections:
+        position += -position % ALIGNMENT
+        offsets.append(position)
+        position += len(section)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(outer_words), len(inner_words), len(inner_ids), value_type, *offsets))
+        for offset, section in zip(offsets, sections):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(section)
+
+
+def _string_section(words):
+    encoded = [word.encode('utf8') for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(word) for word in encoded])
+    return offsets, b''.join(encoded)
+
+
+def open_table(file_name):
+    """
+        Opens a mapped table from the dictionary folder, the mapped version of load_dict_pickle()
+
+        :param file_name: the name of the file to open without the extension, e.g. 2008_country_artist or 2008_plays
+        :type file_name: str
+
+        :rtype: MappedTable
+    """
+
+    return MappedTable(dictionary_path(file_name, '.tab'))
+
+
+def convert_pickle(file_name):
+    """
+        Converts a pickle file in the dictionary folder to mapped table files next to it
+
+        The plays pickle is split into one YYYY_plays file per year, the other pickles become one file each. Only
+        2 level dictionaries (plays by year and the country_artist / country_listeners dictionaries) can be mapped,
+        other pickles like user_country raise a ValueError.
+
+        :param file_name: the name of the pickle file without the extension
+        :type file_name: str
+
+        :return: the names of the mapped table files that were written
+        :rtype: list
+    """
+
+    with open(dictionary_path(file_name), 'rb') as f:
+        dictionary = pickle.load(f)
+
+    if file_name == 'plays':
+        tables = {year + '_plays': dictionary[year] for year in dictionary}
+    else:
+        tables = {file_name: dictionary}
+
+    for name in tables:
+        if not isinstance(tables[name], dict) or not all(isinstance(row, dict) for row in tables[name].values()):
+            raise ValueError(file_name + ' is not a dictionary[outer][inner] = count and can\'t be mapped, only plays '
+                                         'and the country_artist dictionaries can')
+
+    for name in tables:
+        write_table(dictionary_path(name, '.tab'), tables[name])
+
+    return list(tables)
@@ -1,255 +1,1223 @@
+"""
+    This file parses through two last.fm data sets to be able to analyze trends in the different countries for different
+    years.
+
+    The first data set is a record of users and relevant information like user id, country, age, gender, etc. The second
+    data set is a record of playing a track which include the user id, timestamp, artist, song, etc.
+
+    The final data set will be a set of dictionaries (a dictionary for each year in the second data set). The
+    dictionaries are 2D so that the outer dictionary contains countries as keys and the inner dictionaries as values.
+    The inner dictionaries contains artist as keys and the play count (integer) as values
+
+    Importing this file doesn't run anything. The stages are run from the command line, see main():
+        python parse_music_data.py ingest|aggregate|build-graphs|similarity|run|report
+"""
+
+import argparse
 import csv
-# import pickle
-#
-# """
-#     This file parses through two last.fm data sets to be able to analyze trends in the different countries for different
-#     years.
-#
-#     The first data set is a record of users and relevant information like user id, country, age, gender, etc. The second
-#     data set is a record of playing a track which include the user id, timestamp, artist, song, etc.
-#
-#     The final data set will be a set of dictionaries (a dictionary for each year in the second data set). The
-#     dictionaries are 2D so that the outer dictionary contains countries as keys and the inner dictionaries as values.
-#     The inner dictionaries contains artist as keys and the play count (integer) as values
-# """
-#
-#
-# def create_user_country_dict():
-#     """
-#         Maps a user to its country in a dictionary
-#
-#         This goes through the last.fm data set about individual users and makes a dictionary of user-country as the
-#         key-value pairs so we can map a user to their country. It also saves the dictionary in a pickle file
-#
-#         :return user_country_dict: a dictionary that maps user ids to the country they live in
-#         :rtype user_country_dict: dict
-#     """
-#
-#     # ----------- Get tools to read tsv files
-#     file_in = open('../data/userid-profile.tsv', 'r')
-#     reader = csv.reader(file_in, delimiter='\t')
-#
-#     # create dictionary
-#     user_country = dict()
-#     index = 0
-#
-#     # --------- Iterate through tsv file
-#     for row in reader:
-#         # skipping first row with headers
-#         if index == 0:
-#             # do nothing with this row
-#             index += 1
-#             continue
-#
-#         ''''
-#             row[0] = user id
-#             row[3] = country
-#         '''
-#
-#         # make sure the country value is not empty
-#         if row[3] != '':
-#             user_country[row[0]] = row[3]
-#
-#         index += 1
-#
-#     # save dictionary in file and return it
-#     store_dict_pickle("user_country", user_country)
-#     return user_country
-#
-#
-# def create_plays_dict():
-#     """
-#         Maps the play number of times a user plays an artist in a specific year in a 3D dictionary
-#
-#         Goes through the last.fm data set where each row is an instance of a user playing a song. This method takes the
-#         year, user id, and artist from each row. It will add up the number of times each artist a user listens to for a
-#         given year. This will be stored in a 3D dictionary so that play count for an artist can be accessed by year,
-#         user id then artist.
-#
-#         It also saves the dictionary to a pickle file
-#
-#        :return dict plays_dict: a dictionary that maps the play number of times a user plays an artist in a specific
-#                year in a 3D dictionary
-#        :rtype plays_dict: dict
-#        dictionary[year][user_id][artist] = artist_play_count
-#             year: string
-#             user_id: string
-#             artist: string
-#             artist_play_count: int
-#
-#     """
-#
-#     # ----------- Get tools to read tsv files
-#     file_in = open('../data/user_track.tsv', 'r', encoding="utf8")
-#     reader = csv.reader(file_in, delimiter='\t', quoting=csv.QUOTE_NONE)
-#
-#     # create dictionary
-#     plays = dict()
-#
-#     # ------------ Iterate Through File
-#     for row in reader:
-#         """
-#             Get the need values from the row
-#
-#             row[0] = user id
-#             row[1] = time-stamp
-#             row[2] = artist id
-#             row[3] = artist name
-#         """
-#
-#         user = row[0]
-#         timestamp = row[1]
-#         artist = row[3]
-#
-#         """
-#             Get the year from the timestamp
-#
-#             Timestamp is in the format: year-month-dayThour:minute:second
-#             example: 2000-03-23T13:31:432
-#         """
-#         year = timestamp.split('-')[0]
-#
-#         # -------- insert values into dictionary
-#         # check if the year exist in the plays dictionary
-#         if year in plays:
-#             '''
-#                 The year key exists
-#                 Check if the user key exists
-#             '''
-#             if user in plays[year]:
-#                 '''
-#                     The user key exists for given year.
-#                     Check if the artist key exists for the user id in the given year
-#                 '''
-#                 if artist in plays[year][user]:
-#                     '''
-#                         Artist key exists within user id for given year
-#                         Increment play count for atist
-#                     '''
-#                     plays[year][user][artist] += 1
-#
-#                 else:
-#                     '''
-#                         The artist key doesn't exist
-#                         Initialize the artist key with a value of 1
-#                     '''
-#                     plays[year][user][artist] = 1
-#
-#             else:
-#                 """
-#                     The user id dictionary for given year does not exist. This means that the vlaue for the artist
-#                     for this year and user id does not exist either.
-#
-#                     So we need to create the user id dictionary and initialize the value for the artist to 1
-#                 """
-#
-#                 plays[year][user] = dict()
-#                 plays[year][user][artist] = 1
-#
-#         else:
-#             """
-#                 The year does not exist. This means that the user id and artist does not exist either. So we have to
-#                 create the year dictionary, the user id dictionary, and the initial value of 1 for the artist plays
-#                 count
-#             """
-#             plays[year] = dict()
-#             plays[year][user] = dict()
-#             plays[year][user][artist] = 1
-#
-#     # store dictionary in pickle file and return it
-#     store_dict_pickle("plays", plays)
-#     return plays
-#
-#
-# def create_country_artist_dict():
-#     """
-#         Creates a dict that maps every artist play count to country for each available year
-#
-#         This method uses the create_user_country_dict() and create_plays_dict() to be able to list the play count for
-#         an artist for each country that it is played in. The results will be stored in a dictionary where it represents
-#         the play count for a specific year
-#
-#         It also saves each year's dictionary to a pickle file
-#     """
-#
-#     # get the two dictionaries so we can interweave the country, user id, and artist play count
-#     user_dict = load_dict_pickle("user_country")
-#     plays_dict = load_dict_pickle("plays")
-#
-#     # go through each year in the plays dict and make a dictionary for each country and the artist count
-#     for year in plays_dict:
-#         # create dictionary for the current year
-#         country_artist = dict()
-#
-#         '''
-#             Go through the plays_dict to get the user_id for each user in the current year in the iteration. Then, get
-#             the country that user belongs to from the user_dict and make a country dict if it doesn't already exist. If
-#             the country dict does exist, then add the artist play count for the current user to the play count in the
-#             country_artist dict
-#         '''
-#         for user in plays_dict[year]:
-#             # get the country the user belongs to
-#             try:
-#                 country = user_dict[user]
-#             except KeyError:
-#                 continue
-#
-#             # if there's not a country dictionary for the given year, then make one
-#             if country not in country_artist:
-#                 country_artist[country] = dict()
-#
-#             for artist in plays_dict[year][user]:
-#                 # check if there's an artist dictionary for the country_artist dict
-#                 if artist in country_artist[country]:
-#                     # increment count by value in plays_dict
-#                     country_artist[country][artist] += plays_dict[year][user][artist]
-#                 else:
-#                     # initialize value to value in plays_dict
-#                     country_artist[country][artist] = plays_dict[year][user][artist]
-#
-#         # save current years dictionary in a pickle file
-#         store_dict_pickle(year+"_country_artist", country_artist)
-#
-#
-# '''
-#     ------------- The below functions are for saving and loading dictionaries from/to files ---------------------
-#     Doing this was taken from: https://stackoverflow.com/questions/19201290/how-to-save-a-dictionary-to-a-file
-# '''
-#
-#
-# #  def store_dict_pickle(file_name, dictionary):
-# #     """
-# #         Saves a dictionary to a pickle file
-# #
-# #         :param file_name: the name of the file the data will be stored in
-# #         :type file_name: str
-# #
-# #         :param dictionary: the dictionary to be stored in the file
-# #         :type dictionary: dict
-# #     """
-# #
-# #
-# #     with open('data/' + file_name + '.pkl', 'wb') as f:
-# #         pickle.dump(dictionary, f, pickle.HIGHEST_PROTOCOL)
-# #
-# #
-# # def load_dict_pickle(file_name):
-# #     """
-# #     Retrieves a dictionary form the specified file
-# #
-# #     :param file_name: the name of the file to load
-# #     :type file_name: str
-# #
-# #     :return: the dictionary retrieved from the file
-# #     :rtype dict
-# #     """
-# #
-# #     with open('../data/dictionary/' + file_name + '.pkl', 'rb') as f:
-# #         dictionary =  pickle.load(f)
-# #     return dictionary
-#
-#
-#
+import os
+import pickle
+import re
+import time
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pool
+
+from compressed_reader import is_compressed, read_compressed_lines
+from graphs import top_artists, top_artists_graphs
+from paths import DICTIONARY_DIRECTORY, JACCARD_FILE, PROFILE_FILE, USER_TRACK_FILE, dictionary_path
+from pipeline import Stage, run_stages
+from profiles import read_profile_tsv
+from similarity import graph_neighborhoods, write_jaccard_csv, years_jaccard
+from sketches import ListenerTable, SketchTable, SpaceSaving
+from time_buckets import BUCKET_LEVELS, time_bucket_counts
+from top_k import top_k_dict
+from vocabulary import (NORMALIZATIONS, EncodedCounts, Vocabulary, distinct_listeners, encode_plays_table,
+                        encode_user_country, join_user_country, normalize_user_plays)
+
+# the years compared in the graphs and Jaccard similarities
+YEARS = ('2005', '2006', '2007', '2008', '2009')
+
+
+def create_user_country_dict():
+    """
+        Maps a user to its country in a dictionary
+
+        This goes through the last.fm data set about individual users and makes a dictionary of user-country as the
+        key-value pairs so we can map a user to their country. It also saves the dictionary in a pickle file
+
+        :return user_country_dict: a dictionary that maps user ids to the country they live in
+        :rtype user_country_dict: dict
+    """
+
+    # the users with an empty country value are left out
+    user_country = load_profile_table().user_country()
+
+    # save dictionary in file and return it
+    store_dict_pickle("user_country", user_country)
+    return user_country
+
+
+def create_plays_dict(processes=1, checkpoint_bytes=None, resume=False, file_name=USER_TRACK_FILE):
+    """
+        Maps the play number of times a user plays an artist in a specific year in a 3D dictionary
+
+        Goes through the last.fm data set where each row is an instance of a user playing a song. This method takes the
+        year, user id, and artist from each row. It will add up the number of times each artist a user listens to for a
+        given year. This will be stored in a 3D dictionary so that play count for an artist can be accessed by year,
+        user id then artist.
+
+        When more than one process is given the file is read in parallel, see scan_user_track(). A long single
+        process read can save checkpoints and be resumed after a crash, see scan_user_track_checkpointed().
+
+        It also saves the dictionary to a pickle file, together with the offset the file was read up to so that
+        ingest_delta() only adds rows appended after it. The plays_encoded table of an earlier read is removed in the
+        same commit, so the two never hold different rows.
+
+       :param processes: the number of processes used to read the file, 1 reads it in this process
+       :type processes: int
+
+       :param checkpoint_bytes: save a checkpoint after about this many bytes of the file, None for no checkpoints
+       :type checkpoint_bytes: int
+
+       :param resume: continue from the last checkpoint instead of the start of the file
+       :type resume: bool
+
+       :param file_name: the user_track file to read, it can be compressed
+       :type file_name: str
+
+       :return dict plays_dict: a dictionary that maps the play number of times a user plays an artist in a specific
+               year in a 3D dictionary
+       :rtype plays_dict: dict
+       dictionary[year][user_id][artist] = artist_play_count
+            year: string
+            user_id: string
+            artist: string
+            artist_play_count: int
+
+    """
+
+    recover_pickle_journal()
+    end = scan_end(file_name)
+    plays = scan_user_track(processes, checkpoint_bytes=checkpoint_bytes, resume=resume, file_name=file_name, end=end)
+
+    # store dictionary in pickle file together with its watermark and return it
+    watermarks = full_read_watermarks("plays", file_name, end)
+    watermarks.pop("plays_encoded", None)
+    commit_pickles({"plays": plays, "plays_encoded": None, "watermarks": watermarks})
+    return plays
+
+
+def create_encoded_plays(processes=1, file_name=USER_TRACK_FILE):
+    """
+        Counts the plays of every user and artist in every year straight into integer id arrays
+
+        The counts are the same as create_plays_dict() makes, but every row is added to an EncodedCounts table while
+        the file is read (see vocabulary.py), so the nested dictionaries of strings are never built. The table keeps
+        the user and artist vocabularies, and create_country_artist_dict() joins its arrays to the countries without
+        decoding them.
+
+        It also saves the table to the plays_encoded pickle file, together with the offset the file was read up to.
+        The plays dictionary of an earlier read is removed in the same commit, load_plays() decodes the table instead.
+
+        :param processes: the number of processes used to read the file, 1 reads it in this process
+        :type processes: int
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :return: table of year, user id and artist
+        :rtype: EncodedCounts
+    """
+
+    recover_pickle_journal()
+    end = scan_end(file_name)
+    plays = fill_table(EncodedCounts(), EncodedCounts.add, None, processes, file_name, end)
+
+    watermarks = full_read_watermarks("plays_encoded", file_name, end)
+    watermarks.pop("plays", None)
+    commit_pickles({"plays_encoded": plays, "plays": None, "watermarks": watermarks})
+    return plays
+
+
+def scan_user_track(processes=1, user_dict=None, checkpoint_bytes=None, resume=False, by_day=False,
+                    file_name=USER_TRACK_FILE, end=None):
+    """
+        Reads the user_track data set once and counts the plays in it
+
+        When more than one process is given, the file is split into byte ranges that end on a newline and each range
+        is counted in its own process. The partial dictionaries are then merged in file order, so the result is the
+        same as reading the file in one pass.
+
+        A .gz, .bz2 or .xz file is read directly while it is decompressed in another thread (see compressed_reader.py).
+        Compressed files can't be split into byte ranges, so they are always parsed in one process.
+
+        :param processes: the number of processes used to read the file, 1 reads it in this process
+        :type processes: int
+
+        :param user_dict: maps user ids to countries, when given the plays are counted by country instead of user
+        :type user_dict: dict
+
+        :param checkpoint_bytes: save a checkpoint after about this many bytes, see scan_user_track_checkpointed()
+        :type checkpoint_bytes: int
+
+        :param resume: continue from the last checkpoint
+        :type resume: bool
+
+        :param by_day: count the plays by day (year-month-day) instead of by year
+        :type by_day: bool
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :param end: only read the rows before this byte offset of an uncompressed file, see scan_end(). None reads
+                    the whole file.
+        :type end: int
+
+        :return: dictionary[year][user_id or country][artist] = artist_play_count
+        :rtype: dict
+    """
+
+    if checkpoint_bytes is not None or resume:
+        if processes > 1 or is_compressed(file_name):
+            raise ValueError('checkpoints are only supported when an uncompressed file is read in one process')
+        return scan_user_track_checkpointed(user_dict, checkpoint_bytes, resume, by_day, file_name, end)
+
+    return fill_table(dict(), add_play, user_dict, processes, file_name, end, by_day, merge_plays_dict)
+
+
+def scan_end(file_name):
+    """
+        Finds where a full read of a user_track file stops
+
+        A full read stops after the last complete line, the same as ingest_delta(), so a last line that is still being
+        written is read by the next delta instead of being counted twice.
+
+        :return: the offset after the last complete line, or None for a compressed file which can't be read from an
+                 offset and is always read whole
+        :rtype: int
+    """
+
+    if is_compressed(file_name):
+        return None
+    return complete_lines_end(file_name, 0)
+
+
+def scan_user_track_checkpointed(user_dict=None, checkpoint_bytes=None, resume=False, by_day=False,
+                                 file_name=USER_TRACK_FILE, end=None):
+    """
+        Reads the user_track data set in one process, saving the partial counts and the file offset as it goes
+
+        The file is read in newline aligned byte ranges of about checkpoint_bytes. After each range the counts so far
+        and the offset of the next range are saved in a checkpoint pickle, so a crashed or preempted run can be
+        resumed from the last range instead of the start of the file. The checkpoint is removed once the whole file
+        has been read.
+
+        :param user_dict: maps user ids to countries, when given the plays are counted by country instead of user
+        :type user_dict: dict
+
+        :param checkpoint_bytes: the size of the ranges between checkpoints, None reads the rest in one range
+        :type checkpoint_bytes: int
+
+        :param resume: continue from the last checkpoint, if there is one
+        :type resume: bool
+
+        :param by_day: count the plays by day instead of by year
+        :type by_day: bool
+
+        :param file_name: the uncompressed user_track file to read
+        :type file_name: str
+
+        :param end: only read the rows before this byte offset, None reads the whole file
+        :type end: int
+
+        :return: dictionary[year][user_id or country][artist] = artist_play_count
+        :rtype: dict
+    """
+
+    # counts by user and by country (or by day) are different dictionaries so they get different checkpoints
+    checkpoint_name = "plays_checkpoint" if user_dict is None else "country_artist_checkpoint"
+    if by_day:
+        checkpoint_name = "day_" + checkpoint_name
+    size = os.path.getsize(file_name) if end is None else end
+
+    checkpoint = load_dict_pickle_or_empty(checkpoint_name) if resume else dict()
+    if checkpoint and checkpoint['source'] != (os.path.abspath(file_name), size):
+        raise ValueError('the checkpoint was made from a different user_track file')
+
+    plays = checkpoint.get('plays', dict())
+    start = checkpoint.get('offset', 0)
+
+    while start < size:
+        end = size if checkpoint_bytes is None else min(line_start_after(file_name, start + checkpoint_bytes), size)
+
+        count_byte_range(file_name, start, end, user_dict, by_day, plays)
+        start = end
+
+        if start < size:
+            store_dict_pickle(checkpoint_name, {'source': (os.path.abspath(file_name), size),
+                                                'offset': start,
+                                                'plays': plays})
+
+    # the file has been read so the checkpoint isn't needed anymore
+    if os.path.exists(dictionary_path(checkpoint_name)):
+        os.remove(dictionary_path(checkpoint_name))
+
+    return plays
+
+
+def count_plays_rows(plays, reader, user_dict=None, by_day=False, add=None):
+    """
+        Adds a play to the plays dictionary for every row of the user_track data set
+
+        :param plays: the dictionary that maps year, user id, then artist to the play count
+        :type plays: dict
+
+        :param reader: the rows of the user_track data set
+        :type reader: iterable
+
+        :param user_dict: maps user ids to countries, when given plays are added under the user's country instead of
+                          the user id and users without a country are skipped
+        :type user_dict: dict
+
+        :param by_day: use the day (year-month-day) of the timestamp as the outer key instead of the year
+        :type by_day: bool
+
+        :param add: function called as add(plays, year, user_id or country, artist) for every row, add_play() by
+                    default. Other functions let plays be something other than a dictionary, like a SketchTable.
+        :type add: function
+    """
+
+    if add is None:
+        add = add_play
+
+    for row in reader:
+        """
+            Get the need values from the row
+
+            row[0] = user id
+            row[1] = time-stamp
+            row[2] = artist id
+            row[3] = artist name
+        """
+
+        user = row[0]
+        timestamp = row[1]
+        artist = row[3]
+
+        """
+            Get the year from the timestamp
+
+            Timestamp is in the format: year-month-dayThour:minute:second
+            example: 2000-03-23T13:31:432
+        """
+        if by_day:
+            year = timestamp[:10]
+        else:
+            year = timestamp.split('-')[0]
+
+        # join the row to the user's country when counting by country
+        if user_dict is not None:
+            try:
+                user = user_dict[user]
+            except KeyError:
+                continue
+
+        add(plays, year, user, artist)
+
+
+def add_play(plays, year, user, artist, count=1):
+    """
+        Adds play count for an artist to the plays dictionary, creating the year and user dictionaries if needed
+
+        :param plays: the dictionary that maps year, user id, then artist to the play count
+        :type plays: dict
+
+        :param count: the number of plays to add
+        :type count: int
+    """
+
+    # -------- insert values into dictionary
+    # check if the year exist in the plays dictionary
+    if year in plays:
+        '''
+            The year key exists
+            Check if the user key exists
+        '''
+        if user in plays[year]:
+            '''
+                The user key exists for given year.
+                Check if the artist key exists for the user id in the given year
+            '''
+            if artist in plays[year][user]:
+                '''
+                    Artist key exists within user id for given year
+                    Increment play count for atist
+                '''
+                plays[year][user][artist] += count
+
+            else:
+                '''
+                    The artist key doesn't exist
+                    Initialize the artist key with the play count
+                '''
+                plays[year][user][artist] = count
+
+        else:
+            """
+                The user id dictionary for given year does not exist. This means that the vlaue for the artist
+                for this year and user id does not exist either.
+
+                So we need to create the user id dictionary and initialize the value for the artist to the play count
+            """
+
+            plays[year][user] = dict()
+            plays[year][user][artist] = count
+
+    else:
+        """
+            The year does not exist. This means that the user id and artist does not exist either. So we have to
+            create the year dictionary, the user id dictionary, and the initial play count for the artist
+        """
+        plays[year] = dict()
+        plays[year][user] = dict()
+        plays[year][user][artist] = count
+
+
+def merge_plays_dict(plays, partial):
+    """
+        Adds every play count in a partial plays dictionary to the plays dictionary
+
+        :param plays: the dictionary the counts are added to
+        :type plays: dict
+
+        :param partial: a plays dictionary made from part of the data set
+        :type partial: dict
+    """
+
+    for year in partial:
+        for user in partial[year]:
+            for artist in partial[year][user]:
+                add_play(plays, year, user, artist, partial[year][user][artist])
+
+
+'''
+    ------------- The below functions split a tsv file into byte ranges so it can be read by several processes ---------
+'''
+
+
+def split_byte_ranges(file_name, number_of_ranges, size=None):
+    """
+        Splits a file into byte ranges that each start at the beginning of a line
+
+        :param file_name: the path of the file to split
+        :type file_name: str
+
+        :param number_of_ranges: the number of ranges to try to make, small files can have fewer
+        :type number_of_ranges: int
+
+        :param size: only split the bytes before this offset, which has to be the start of a line. None splits the
+                     whole file.
+        :type size: int
+
+        :return: list of (start, end) byte offsets, the end offset is not part of the range
+        :rtype: list
+    """
+
+    if size is None:
+        size = os.path.getsize(file_name)
+    boundaries = [0]
+
+    for i in range(1, number_of_ranges):
+        # move the guessed boundary forward to the start of the next line
+        position = line_start_after(file_name, max(size * i // number_of_ranges, boundaries[-1] + 1))
+
+        if boundaries[-1] < position < size:
+            boundaries.append(position)
+
+    boundaries.append(size)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+
+def line_start_after(file_name, offset):
+    """
+        Finds the start of the first line that begins at or after the given offset
+
+        :return: the offset of the line start, or the size of the file if there isn't one
+        :rtype: int
+    """
+
+    with open(file_name, 'rb') as f:
+        # an offset right after a newline is already the start of a line
+        f.seek(max(offset - 1, 0))
+        if offset > 0:
+            f.readline()
+        return f.tell()
+
+
+def read_byte_range(file_name, start, end, encoding="utf8"):
+    """
+        Reads the lines of a file that start in the given byte range
+
+        :param file_name: the path of the file to read
+        :type file_name: str
+
+        :param start: the offset of the first byte of the range, must be at the start of a line
+        :type start: int
+
+        :param end: the offset just after the last byte of the range
+        :type end: int
+
+        :return: generator of the decoded lines
+        :rtype: generator
+    """
+
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode(encoding)
+
+
+def count_byte_range(file_name, start, end, user_dict=None, by_day=False, table=None, add=add_play):
+    """
+        Counts the rows of the user_track data set in the given byte range
+
+        :param table: the table to count into, e.g. a SketchTable, None makes a new plays dictionary
+        :param add: the function that adds a row to the table, see count_plays_rows()
+
+        :return: the table, by default a dictionary that maps year, user id (or country when user_dict is given), then
+                 artist to the play count for the rows in the range
+    """
+
+    if table is None:
+        table = dict()
+
+    count_plays_rows(table, user_track_rows(file_name, start, end), user_dict, by_day, add)
+    return table
+
+
+def user_track_rows(file_name, start=0, end=None):
+    """
+        Reads the rows of a user_track file, every scan of the data set goes through here
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :param start: the offset of the first row to read, must be at the start of a line
+        :type start: int
+
+        :param end: only read the rows that start before this byte offset, None reads to the end of the file. A
+                    compressed file can't be read from an offset, it raises a ValueError unless it is read whole.
+        :type end: int
+
+        :return: generator of the rows split into their fields
+        :rtype: generator
+    """
+
+    if is_compressed(file_name):
+        if start > 0 or end is not None:
+            raise ValueError(file_name + ' is compressed, it can only be read whole')
+        lines = read_compressed_lines(file_name)
+    elif start == 0 and (end is None or end >= os.path.getsize(file_name)):
+        # the whole file is read as text, which is faster than decoding every line of a byte range
+        lines = open(file_name, 'r', encoding="utf8")
+    else:
+        lines = read_byte_range(file_name, start, end)
+
+    # the file and the generators are all closed the same way, also when the rows aren't all read
+    try:
+        yield from csv.reader(lines, delimiter='\t', quoting=csv.QUOTE_NONE)
+    finally:
+        lines.close()
+
+
+def create_country_artist_dict(encoded=False, normalization='plays', cap=None):
+    """
+        Creates a dict that maps every artist play count to country for each available year
+
+        This method uses the create_user_country_dict() and create_plays_dict() to be able to list the play count for
+        an artist for each country that it is played in. The results will be stored in a dictionary where it represents
+        the play count for a specific year
+
+        When encoded is True the encoded plays (see load_encoded_plays()) are joined to the countries as integer id
+        arrays and the result is saved as an EncodedCounts table of year, country and artist in the
+        country_artist_encoded pickle file, without making any dictionaries. build-graphs --encoded decodes the years
+        it needs from it.
+
+        The normalization limits how much one user adds to a country, see vocabulary.normalize_user_plays(). Anything
+        other than 'plays' is done on the encoded arrays and saved as YYYY_country_artist_<normalization> (with the cap
+        added for 'cap', e.g. 2008_country_artist_cap100) so the raw dictionaries are kept. The encoded file gets the
+        same suffix, e.g. country_artist_share_encoded. build-graphs --normalization makes graphs from them.
+
+        It also saves each year's dictionary to a pickle file. The raw dictionaries are saved together with the
+        watermarks of the plays dictionary they were made from, so ingest_delta() keeps adding to them from there.
+
+        :param encoded: join the encoded plays and save the id arrays instead of dictionaries
+        :type encoded: bool
+
+        :param normalization: 'plays', 'cap' or 'share'
+        :type normalization: str
+
+        :param cap: the most plays counted per user and artist for the 'cap' normalization
+        :type cap: int
+    """
+
+    # get the two dictionaries so we can interweave the country, user id, and artist play count
+    recover_pickle_journal()
+    user_dict = load_dict_pickle("user_country")
+
+    suffix = weights_suffix('plays', normalization, cap)
+
+    if encoded:
+        # ------------ Join the encoded plays to the countries, the result stays encoded
+        country_artist = join_encoded_plays(load_encoded_plays(), user_dict, normalization, cap)
+        store_dict_pickle("country_artist" + suffix + "_encoded", country_artist)
+        return
+
+    plays_dict = load_plays()
+
+    if suffix:
+        # ------------ Normalize and join as id arrays, then decode a dictionary for every year
+        country_artist = join_encoded_plays(encode_plays_table(plays_dict), user_dict, normalization, cap)
+        for year in country_artist:
+            store_dict_pickle(year+"_country_artist"+suffix, country_artist.to_dict(year))
+        return
+
+    # the country_artist dictionaries hold the same rows as the plays, which load_plays() may have decoded
+    watermarks = load_watermarks()
+    plays_name = "plays" if os.path.exists(dictionary_path("plays")) else "plays_encoded"
+    watermarks["country_artist"] = dict(watermarks.get(plays_name, dict()))
+
+    # go through each year in the plays dict and make a dictionary for each country and the artist count
+    year_dicts = dict()
+    for year in plays_dict:
+        # create dictionary for the current year
+        country_artist = dict()
+
+        add_user_plays_by_country(country_artist, plays_dict[year], user_dict)
+        year_dicts[year+"_country_artist"] = country_artist
+
+    # save every years dictionary in a pickle file, together with the watermarks
+    year_dicts["watermarks"] = watermarks
+    commit_pickles(year_dicts)
+
+
+def create_country_listeners_dict(encoded=False):
+    """
+        Creates a dict that maps the number of distinct listeners of every artist to country for each available year
+
+        This is an alternative edge weight to the play count in create_country_artist_dict(), where every user counts
+        once for an artist however many times they played it. It is computed on integer id arrays of the plays
+        dictionary, see vocabulary.distinct_listeners()
+
+        It also saves each year's dictionary to a YYYY_country_listeners pickle file, or when encoded is True the
+        encoded plays are used and the result is saved as an EncodedCounts table in the country_listeners_encoded
+        pickle file
+
+        :param encoded: use the encoded plays and save the id arrays instead of dictionaries
+        :type encoded: bool
+
+        :return: table of year, country and artist with the number of distinct listeners as the counts
+        :rtype: EncodedCounts
+    """
+
+    user_dict = load_dict_pickle("user_country")
+
+    if encoded:
+        country_listeners = join_encoded_plays(load_encoded_plays(), user_dict, listeners=True)
+        store_dict_pickle("country_listeners_encoded", country_listeners)
+        return country_listeners
+
+    country_listeners = join_encoded_plays(encode_plays_table(load_plays()), user_dict, listeners=True)
+    for year in country_listeners:
+        store_dict_pickle(year+"_country_listeners", country_listeners.to_dict(year))
+
+    return country_listeners
+
+
+def load_plays():
+    """
+        Gets the plays dictionary, decoded from the plays_encoded table if only that was made by create_encoded_plays()
+
+        :return: dictionary[year][user_id][artist] = artist_play_count
+        :rtype: dict
+    """
+
+    try:
+        return load_dict_pickle("plays")
+    except FileNotFoundError:
+        plays = load_dict_pickle("plays_encoded")
+        return {year: plays.to_dict(year) for year in plays}
+
+
+def load_encoded_plays():
+    """
+        Gets the plays as an EncodedCounts table of year, user id and artist
+
+        The table is the plays_encoded pickle made by create_encoded_plays(). If there isn't one, the plays dictionary
+        is encoded once and saved as plays_encoded together with its watermarks, so later runs load the arrays.
+
+        A full read of either one removes the other, and ingest_delta() updates both or neither, so when both exist
+        they hold the rows up to the same watermarks. If they don't, a ValueError is raised rather than joining stale
+        plays.
+
+        :rtype: EncodedCounts
+    """
+
+    watermarks = load_watermarks()
+    if os.path.exists(dictionary_path("plays_encoded")):
+        if os.path.exists(dictionary_path("plays")) and \
+                watermarks.get("plays_encoded", dict()) != watermarks.get("plays", dict()):
+            raise ValueError('plays_encoded and plays were read from different rows, run ingest again')
+        return load_dict_pickle("plays_encoded")
+
+    plays = encode_plays_table(load_dict_pickle("plays"))
+
+    watermarks["plays_encoded"] = dict(watermarks.get("plays", dict()))
+    commit_pickles({"plays_encoded": plays, "watermarks": watermarks})
+    return plays
+
+
+def join_encoded_plays(plays, user_dict, normalization='plays', cap=None, listeners=False):
+    """
+        Adds up every year of the encoded plays by the users' countries
+
+        :param plays: table of year, user id and artist
+        :type plays: EncodedCounts
+
+        :param user_dict: maps user ids to the country they live in
+        :type user_dict: dict
+
+        :param normalization: 'plays', 'cap' or 'share', see vocabulary.normalize_user_plays()
+        :type normalization: str
+
+        :param cap: the most plays counted per user and artist for the 'cap' normalization
+        :type cap: int
+
+        :param listeners: count the distinct listeners instead of the plays, see vocabulary.distinct_listeners()
+        :type listeners: bool
+
+        :return: table of year, country and artist that shares the artist vocabulary of the plays
+        :rtype: EncodedCounts
+    """
+
+    # the users without plays are added to the user vocabulary, they are never looked up
+    countries = Vocabulary()
+    user_country_ids = encode_user_country(user_dict, plays.outer, countries)
+
+    joined = dict()
+    for year in plays:
+        if listeners:
+            joined[year] = distinct_listeners(plays.arrays(year), user_country_ids, len(plays.inner))
+        else:
+            weighted_plays = normalize_user_plays(plays.arrays(year), normalization, cap)
+            joined[year] = join_user_country(weighted_plays, user_country_ids, len(plays.inner))
+
+    return EncodedCounts.from_encoded(joined, countries, plays.inner)
+
+
+def add_user_plays_by_country(country_artist, user_plays, user_dict):
+    """
+        Adds one year of user play counts to the country_artist dictionary of that year
+
+        :param country_artist: dictionary[country][artist] = artist_play_count, updated in place
+        :type country_artist: dict
+
+        :param user_plays: dictionary[user_id][artist] = artist_play_count for the same year
+        :type user_plays: dict
+
+        :param user_dict: maps user ids to the country they live in
+        :type user_dict: dict
+    """
+
+    '''
+        Go through the user_plays to get the user_id for each user in the year. Then, get the country that user belongs
+        to from the user_dict and make a country dict if it doesn't already exist. If the country dict does exist, then
+        add the artist play count for the current user to the play count in the country_artist dict
+    '''
+    for user in user_plays:
+        # get the country the user belongs to
+        try:
+            country = user_dict[user]
+        except KeyError:
+            continue
+
+        # if there's not a country dictionary for the given year, then make one
+        if country not in country_artist:
+            country_artist[country] = dict()
+
+        for artist in user_plays[user]:
+            # check if there's an artist dictionary for the country_artist dict
+            if artist in country_artist[country]:
+                # increment count by value in user_plays
+                country_artist[country][artist] += user_plays[user][artist]
+            else:
+                # initialize value to value in user_plays
+                country_artist[country][artist] = user_plays[user][artist]
+
+
+def create_country_artist_dict_fused(processes=1, checkpoint_bytes=None, resume=False, file_name=USER_TRACK_FILE):
+    """
+        Creates the same per year country_artist dictionaries as create_country_artist_dict() straight from the
+        user_track data set
+
+        Every row is joined to the user's country while the file is read, so the per user plays dictionary is never
+        built or reloaded from its pickle file. This uses much less memory and skips the plays.pkl round trip.
+
+        It also saves each year's dictionary to a pickle file, together with the offset the file was read up to
+
+        :param processes: the number of processes used to read the file, 1 reads it in this process
+        :type processes: int
+
+        :param checkpoint_bytes: save a checkpoint after about this many bytes of the file, None for no checkpoints
+        :type checkpoint_bytes: int
+
+        :param resume: continue from the last checkpoint instead of the start of the file
+        :type resume: bool
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :return: dictionary[year][country][artist] = artist_play_count
+        :rtype: dict
+    """
+
+    recover_pickle_journal()
+    user_dict = load_dict_pickle("user_country")
+    end = scan_end(file_name)
+    country_artist = scan_user_track(processes, user_dict, checkpoint_bytes, resume, file_name=file_name, end=end)
+
+    # save each years dictionary in a pickle file, together with the watermark
+    year_dicts = {year+"_country_artist": country_artist[year] for year in country_artist}
+    year_dicts["watermarks"] = full_read_watermarks("country_artist", file_name, end)
+    commit_pickles(year_dicts)
+
+    return country_artist
+
+
+def create_time_bucket_counts(processes=1, levels=BUCKET_LEVELS, file_name=USER_TRACK_FILE):
+    """
+        Creates country-artist play counts for time buckets smaller than a year (quarter, month, ISO week, day)
+
+        The user_track data set is read once with the plays joined to the user's country and counted by day into an
+        EncodedCounts table of integer ids, so no nested dictionary of days is built. Then the day counts are added up
+        into every level, see time_buckets.py
+
+        It also saves the counts to the time_buckets pickle file
+
+        :param processes: the number of processes used to read the file, 1 reads it in this process
+        :type processes: int
+
+        :param levels: the bucket levels to make, from time_buckets.BUCKET_LEVELS
+        :type levels: tuple
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :return: dictionary[level] = TimeBucketCounts
+        :rtype: dict
+    """
+
+    user_dict = load_dict_pickle("user_country")
+    day_counts = fill_table(EncodedCounts(), EncodedCounts.add, user_dict, processes, file_name, by_day=True)
+
+    buckets = time_bucket_counts(day_counts, levels)
+    store_dict_pickle("time_buckets", buckets)
+    return buckets
+
+
+def create_country_artist_sketches(capacity=100, processes=1, file_name=USER_TRACK_FILE):
+    """
+        Creates a Space-Saving summary of the most played artists for every country in every year
+
+        Each summary keeps at most capacity artists however many are played, so memory is bounded while the
+        user_track data set is read. The top artists come with error bounds, see sketches.py
+
+        It also saves the summaries to the country_artist_sketches pickle file
+
+        :param capacity: the number of artists each summary keeps, the top k is accurate for k well below it
+        :type capacity: int
+
+        :param processes: the number of processes used to read the file, 1 reads it in this process
+        :type processes: int
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :return: table where table[year][country] is a SpaceSaving summary
+        :rtype: SketchTable
+    """
+
+    user_dict = load_dict_pickle("user_country")
+    table = fill_table(SketchTable(partial(SpaceSaving, capacity)), SketchTable.add, user_dict, processes, file_name)
+
+    store_dict_pickle("country_artist_sketches", table)
+    return table
+
+
+def create_distinct_listener_sketches(precision=10, processes=1, file_name=USER_TRACK_FILE):
+    """
+        Creates a HyperLogLog of the distinct listeners of every artist in every country for every year
+
+        This is an alternative edge weight to the play count that isn't dominated by a few heavy users, and it is
+        made while the user_track data set is read without keeping the per user plays dictionary, see sketches.py
+
+        It also saves the sketches to the distinct_listener_sketches pickle file
+
+        :param precision: the sketches have 2**precision registers, the standard error is 1.04 / sqrt(2**precision)
+        :type precision: int
+
+        :param processes: the number of processes used to read the file, 1 reads it in this process
+        :type processes: int
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :return: table where table.distinct_listeners(year) is dictionary[country][artist] = number of listeners
+        :rtype: ListenerTable
+    """
+
+    # the table looks up the countries itself since it needs the user ids
+    table = ListenerTable(load_dict_pickle("user_country"), precision)
+    table = fill_table(table, ListenerTable.add, None, processes, file_name)
+
+    store_dict_pickle("distinct_listener_sketches", table)
+    return table
+
+
+def fill_table(table, add, user_dict=None, processes=1, file_name=USER_TRACK_FILE, end=None, by_day=False,
+               merge=None):
+    """
+        Reads the user_track data set once and adds every row to a table
+
+        When more than one process is given, the file is split into byte ranges that end on a newline and each range
+        fills its own copy of the empty table in its own process. The copies are then merged in file order, so the
+        result is the same as reading the file in one pass.
+
+        A .gz, .bz2 or .xz file is read directly while it is decompressed in another thread (see compressed_reader.py).
+        Compressed files can't be split into byte ranges, so they are always parsed in one process.
+
+        :param table: an empty table, e.g. a plays dictionary, an EncodedCounts or a SketchTable
+        :param add: the function that adds a row to the table, see count_plays_rows()
+
+        :param user_dict: maps user ids to countries, when given the rows are added by country instead of user
+        :type user_dict: dict
+
+        :param processes: the number of processes used to read the file, 1 reads it in this process
+        :type processes: int
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :param end: only read the rows before this byte offset of an uncompressed file, see scan_end(). None reads
+                    the whole file.
+        :type end: int
+
+        :param by_day: add the rows by day (year-month-day) instead of by year
+        :type by_day: bool
+
+        :param merge: the function called as merge(table, other) to add the table of one byte range to another,
+                      table.merge(other) by default and merge_plays_dict() for a plays dictionary
+        :type merge: function
+
+        :return: the filled table
+    """
+
+    if processes > 1 and not is_compressed(file_name):
+        # ------------ Fill a table for each byte range in its own process and merge them in file order
+        ranges = split_byte_ranges(file_name, processes, end)
+        with Pool(processes) as pool:
+            partials = pool.starmap(count_byte_range,
+                                    [(file_name, range_start, range_end, user_dict, by_day, table, add)
+                                     for range_start, range_end in ranges])
+
+        table = partials[0]
+        for other in partials[1:]:
+            if merge is None:
+                table.merge(other)
+            else:
+                merge(table, other)
+        return table
+
+    count_plays_rows(table, user_track_rows(file_name, 0, end), user_dict, by_day, add)
+    return table
+
+
+'''
+    ------------- The below functions add new rows of a user_track file to the stored dictionaries ---------------------
+'''
+
+
+def ingest_delta(file_name, update_plays=False):
+    """
+        Adds the rows of a user_track file that haven't been read yet to the stored dictionaries
+
+        The byte offset that has been read up to is kept for each source file in the watermarks pickle, separately
+        for the plays and the country_artist dictionaries since they can be made from different reads (see
+        full_read_watermarks()). Only the rows after it are read, so a log that grows every day or a new delta file
+        costs time for the new rows only. The country_artist dictionaries of the years in the new rows are updated in
+        place. A last line without a newline is left for the next run, it may still be written.
+
+        The plays dictionary and the plays_encoded table hold every year in one pickle, so adding to them costs a read
+        and a write of all the plays. They are only updated when update_plays is True, otherwise their watermarks stay
+        where they are and a later ingest_delta() with update_plays catches them up from there. When they are updated
+        the other aggregates (see stale_aggregates()) are removed, the normalizations and the distinct listeners depend
+        on all of a user's plays so they can't be updated by adding rows and have to be made again.
+
+        The updated dictionaries and the watermarks are saved with commit_pickles(), so a crash leaves either all of
+        them or none of them updated.
+
+        Compressed files can't be read from a byte offset, so they raise a ValueError. Ingest them whole with
+        create_plays_dict() instead.
+
+        :param file_name: the path of the user_track file to read
+        :type file_name: str
+
+        :param update_plays: also add the new rows to the plays dictionary and the plays_encoded table that exist
+        :type update_plays: bool
+
+        :return: dictionary[year][user_id][artist] = artist_play_count of the new rows only
+        :rtype: dict
+    """
+
+    if is_compressed(file_name):
+        raise ValueError(file_name + ' is compressed, only uncompressed user_track files can be read incrementally')
+
+    recover_pickle_journal()
+
+    watermarks = load_watermarks()
+    source = os.path.abspath(file_name)
+    artifacts = ("country_artist",)
+    if update_plays:
+        has_encoded = os.path.exists(dictionary_path("plays_encoded"))
+        if os.path.exists(dictionary_path("plays")) or not has_encoded:
+            artifacts += ("plays",)
+        if has_encoded:
+            artifacts += ("plays_encoded",)
+    starts = {artifact: watermarks.get(artifact, dict()).get(source, 0) for artifact in artifacts}
+
+    if os.path.getsize(file_name) < max(starts.values()):
+        raise ValueError(file_name + ' is smaller than when it was last read, it is not an appended log')
+
+    start = min(starts.values())
+    end = complete_lines_end(file_name, start)
+    if end == start:
+        return dict()
+
+    # ------------ Count only the new rows, split where one dictionary has already read further than the other
+    offsets = sorted(set(starts.values())) + [end]
+    pieces = {offsets[i]: count_byte_range(file_name, offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1)}
+
+    def rows_after(offset):
+        rows = dict()
+        for piece_start in pieces:
+            if piece_start >= offset:
+                merge_plays_dict(rows, pieces[piece_start])
+        return rows
+
+    delta = rows_after(start)
+
+    # ------------ Add them to the stored dictionaries
+    updated = dict.fromkeys(stale_aggregates()) if update_plays else dict()
+    if "plays" in artifacts:
+        plays = load_dict_pickle_or_empty("plays")
+        merge_plays_dict(plays, rows_after(starts["plays"]))
+        updated["plays"] = plays
+
+    if "plays_encoded" in artifacts:
+        plays_encoded = load_dict_pickle("plays_encoded")
+        new_rows = rows_after(starts["plays_encoded"])
+        for year in new_rows:
+            for user in new_rows[year]:
+                for artist in new_rows[year][user]:
+                    plays_encoded.add(year, user, artist, new_rows[year][user][artist])
+        updated["plays_encoded"] = plays_encoded
+
+    user_dict = load_dict_pickle("user_country")
+    country_artist_delta = rows_after(starts["country_artist"])
+    for year in country_artist_delta:
+        country_artist = load_dict_pickle_or_empty(year+"_country_artist")
+        add_user_plays_by_country(country_artist, country_artist_delta[year], user_dict)
+        updated[year+"_country_artist"] = country_artist
+
+    for artifact in artifacts:
+        watermarks.setdefault(artifact, dict())[source] = end
+    updated["watermarks"] = watermarks
+    commit_pickles(updated)
+
+    return delta
+
+
+def stale_aggregates():
+    """
+        :return: the names of the stored aggregates that ingest_delta() can't update, e.g. 2008_country_listeners,
+                 2008_country_artist_share or country_artist_encoded
+        :rtype: list
+    """
+
+    aggregate = re.compile(r'^(\d{4}_country_listeners|\d{4}_country_artist_\w+|country_\w+_encoded)\.pkl$')
+    return [file_name[:-len('.pkl')] for file_name in sorted(os.listdir(DICTIONARY_DIRECTORY))
+            if aggregate.match(file_name)]
+
+
+def complete_lines_end(file_name, start):
+    """
+        Finds the offset just after the last newline in a file
+
+        :param start: the offset to stop searching at
+        :type start: int
+
+        :return: the offset after the last complete line, or start if there is no complete line after start
+        :rtype: int
+    """
+
+    block_size = 1 << 16
+    with open(file_name, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+
+        while position > start:
+            block_start = max(position - block_size, start)
+            f.seek(block_start)
+            newline = f.read(position - block_start).rfind(b'\n')
+            if newline >= 0:
+                return block_start + newline + 1
+            position = block_start
+
+    return start
+
+
+def load_watermarks():
+    """
+        :return: dictionary["plays", "plays_encoded" or "country_artist"][absolute path of a user_track file] = byte
+                 offset that dictionary holds the rows of the file up to
+        :rtype: dict
+    """
+
+    return load_dict_pickle_or_empty("watermarks")
+
+
+def full_read_watermarks(artifact, file_name, end):
+    """
+        Gets the watermarks after a dictionary was made again from the whole of one file
+
+        The watermarks of other files are dropped for that dictionary since it doesn't hold their rows anymore.
+
+        :param artifact: "plays", "plays_encoded" or "country_artist"
+        :type artifact: str
+
+        :param file_name: the user_track file that was read
+        :type file_name: str
+
+        :param end: the offset the file was read up to, None for a compressed file which has no watermark
+        :type end: int
+
+        :return: all the watermarks with the ones of the dictionary replaced
+        :rtype: dict
+    """
+
+    watermarks = load_watermarks()
+    watermarks[artifact] = dict() if end is None else {os.path.abspath(file_name): end}
+    return watermarks
+
+
+def commit_pickles(dictionaries):
+    """
+        Saves several pickle files so that either all of them are replaced or none of them, even after a crash
+
+        Every file is written next to its target first. Then a journal listing them is saved and they are moved into
+        place, and the journal is removed last. A crash before the journal is saved leaves the old files, a crash
+        after it is finished by recover_pickle_journal() before the dictionaries are next read for an update.
+
+        :param dictionaries: dictionary[file name] = the dictionary to store in that file, or None to remove the file
+        :type dictionaries: dict
+    """
+
+    for file_name in dictionaries:
+        if dictionaries[file_name] is not None:
+            with open(dictionary_path(file_name, '.pkl.pending'), 'wb') as f:
+                pickle.dump(dictionaries[file_name], f, pickle.HIGHEST_PROTOCOL)
+
+    # dictionary[file name] = whether the file is replaced, it is removed otherwise
+    store_dict_pickle("journal", {file_name: dictionaries[file_name] is not None for file_name in dictionaries})
+    recover_pickle_journal()
+
+
+def recover_pickle_journal():
+    """
+        Finishes a commit_pickles() that was interrupted after its journal was saved, if there is one
+    """
+
+    journal = load_dict_pickle_or_empty("journal")
+    for file_name, replaced in journal.items():
+        # the files that were already moved into place don't have a pending file anymore
+        if replaced and os.path.exists(dictionary_path(file_name, '.pkl.pending')):
+            os.replace(dictionary_path(file_name, '.pkl.pending'), dictionary_path(file_name))
+        elif not replaced and os.path.exists(dictionary_path(file_name)):
+            os.remove(dictionary_path(file_name))
+
+    if journal:
+        os.remove(dictionary_path("journal"))
+
+
+def load_dict_pickle_or_empty(file_name):
+    """
+        Retrieves a dictionary from the specified file, or an empty dictionary if the file doesn't exist yet
+
+        :rtype: dict
+    """
+
+    try:
+        return load_dict_pickle(file_name)
+    except FileNotFoundError:
+        return dict()
+
+
+'''
+    ------------- The below functions are for saving and loading dictionaries from/to files ---------------------
+    Doing this was taken from: https://stackoverflow.com/questions/19201290/how-to-save-a-dictionary-to-a-file
+'''
+
+
+def store_dict_pickle(file_name, dictionary):
+    """
+        Saves a dictionary to a pickle file
+
+        :param file_name: the name of the file the data will be stored in
+        :type file_name: str
+
+        :param dictionary: the dictionary to be stored in the file
+        :type dictionary: dict
+    """
+
+    # write to a temporary file first so a crash while writing never leaves a broken pickle behind
+    path = dictionary_path(file_name)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(dictionary, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_dict_pickle(file_name):
+    """
+    Retrieves a dictionary form the specified file
+
+    :param file_name: the name of the file to load
+    :type file_name: str
+
+    :return: the dictionary retrieved from the file
+    :rtype dict
+    """
+
+    with open(dictionary_path(file_name), 'rb') as f:
+        dictionary = pickle.load(f)
+    return dictionary
+
+
 # def print_country_artist_dict(country_artist, dict_name):
 #     print(dict_name)
 #     for country in country_artist:
@@ -274,45 +1242,378 @@ import csv
 
 
 def count_user_country_dict():
-    # ----------- Get tools to read tsv files
-    file_in = open('../data/tsv/userid-profile.tsv', 'r')
-    reader = csv.reader(file_in, delimiter='\t')
+    """
+        Counts the number of users in every country
 
-    # create dictionary
-    user_country = dict()
-    country = dict()
-    index = 0
+        :return: dictionary[country] = number of users
+        :rtype: dict
+    """
 
-    # --------- Iterate through tsv file
-    for row in reader:
-        # skipping first row with headers
-        if index == 0:
-            # do nothing with this row
-            index += 1
-            continue
+    return load_profile_table().country_counts()
 
-        ''''
-            row[0] = user id
-            row[3] = country
-        '''
-        country_str = row[3]
-        if country_str is "":
-            continue
-        if not country_str in country:
-            country[country_str] = 1
-        else:
-            country[country_str] += 1
 
-        index += 1
+def load_profile_table():
+    """
+        Gets the user profiles as a typed column table (see profiles.py)
+
+        The table is cached in the profiles pickle file and only made again from userid-profile.tsv when the tsv file
+        is newer than the cache.
+
+        :rtype: ProfileTable
+    """
+
+    cache = dictionary_path("profiles")
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(PROFILE_FILE):
+        return load_dict_pickle("profiles")
+
+    profiles = read_profile_tsv(PROFILE_FILE)
+    store_dict_pickle("profiles", profiles)
+    return profiles
+
+
+'''
+    ------------- The below functions are the stages of the cached pipeline, see pipeline.py ---------------------------
+'''
+
+
+def pipeline_stages(years=YEARS, top_number=5, weighting='plays', output=JACCARD_FILE, processes=1,
+                    file_name=USER_TRACK_FILE, normalization='plays', cap=None):
+    """
+        Makes the stages of the whole pipeline for run_stages():
+            userid-profile.tsv -> user_country
+            user_track.tsv -> plays
+            user_country, plays -> YYYY_country_artist (YYYY_country_listeners, YYYY_country_artist_share, ...)
+                                   for every year
+            YYYY_country_artist -> YYYY_top_N_graph for every year
+            every year's graph -> top_N_jaccard -> the Jaccard CSV file
+
+        :param years: the years that are compared, in order
+        :type years: tuple
+
+        :param top_number: the number of top artists of every country in the graphs
+        :type top_number: int
+
+        :param weighting: 'plays' or 'listeners', what the artists are ranked by
+        :type weighting: str
+
+        :param output: the path of the Jaccard CSV file
+        :type output: str
+
+        :param processes: the number of processes used to read user_track.tsv
+        :type processes: int
+
+        :param file_name: the user_track file to read, it can be compressed
+        :type file_name: str
+
+        :param normalization: 'plays', 'cap' or 'share', see vocabulary.normalize_user_plays()
+        :type normalization: str
+
+        :param cap: the most plays counted per user and artist for the 'cap' normalization
+        :type cap: int
+
+        :rtype: list
+    """
+
+    weights = weights_name(weighting, normalization, cap)
+    jaccard_name = "top_" + str(top_number) + weights_suffix(weighting, normalization, cap) + "_jaccard"
+    names = [graph_name(year, top_number, weighting, normalization, cap) for year in years]
+
+    stages = [Stage("user_country", stage_user_country, files=(PROFILE_FILE,)),
+              Stage("plays", partial(scan_user_track, processes, file_name=file_name), files=(file_name,),
+                    in_process=processes > 1)]
+
+    for year, name in zip(years, names):
+        stages.append(Stage(year + weights, stage_country_artist, ("user_country", "plays"),
+                            {'year': year, 'weighting': weighting, 'normalization': normalization, 'cap': cap}))
+        stages.append(Stage(name, top_artists, (year + weights,), {'top_number': top_number}))
+
+    stages.append(Stage(jaccard_name, stage_years_jaccard, names))
+    stages.append(Stage("jaccard_csv", stage_jaccard_csv, (jaccard_name,),
+                        {'year_labels': list(years), 'file_name': output}, outputs=(output,)))
+
+    return stages
+
+
+def stage_user_country():
+    return load_profile_table().user_country()
+
+
+def stage_country_artist(user_dict, plays_dict, year, weighting='plays', normalization='plays', cap=None):
+    """
+        Adds up one year of the plays dictionary by country, the same as create_country_artist_dict() or
+        create_country_listeners_dict() for a single year
+
+        :return: dictionary[country][artist] = artist_play_count, the normalized weight, or the number of distinct
+                 listeners
+        :rtype: dict
+    """
+
+    year_plays = plays_dict.get(year, dict())
+
+    if weighting == 'listeners' or normalization != 'plays':
+        plays = encode_plays_table({year: year_plays})
+        return join_encoded_plays(plays, user_dict, normalization, cap, weighting == 'listeners').to_dict(year)
+
+    country_artist = dict()
+    add_user_plays_by_country(country_artist, year_plays, user_dict)
+    return country_artist
+
+
+def stage_years_jaccard(*graphs):
+    return years_jaccard([graph_neighborhoods(G) for G in graphs])
+
+
+def stage_jaccard_csv(similarities, year_labels, file_name):
+    write_jaccard_csv(similarities, year_labels, file_name)
+    return file_name
+
+
+'''
+    ------------- The below functions run the stages of the pipeline from the command line -----------------------------
+'''
+
+
+@contextmanager
+def timed(stage):
+    """
+        Prints how long the stage in the with block took
+    """
+
+    start = time.perf_counter()
+    yield
+    print('%s: %.2fs' % (stage, time.perf_counter() - start))
+
+
+def graph_name(year, top_number, weighting='plays', normalization='plays', cap=None):
+    """
+        :return: the name of the pickle file of a top artists graph, e.g. 2008_top_5_graph, 2008_top_5_listeners_graph
+                 or 2008_top_5_share_graph
+        :rtype: str
+    """
+
+    return year + "_top_" + str(top_number) + weights_suffix(weighting, normalization, cap) + "_graph"
+
+
+def weights_suffix(weighting='plays', normalization='plays', cap=None):
+    """
+        Gets what tells the files of a weighting apart
+
+        :param weighting: 'plays' or 'listeners'
+        :type weighting: str
+
+        :param normalization: 'plays', 'cap' or 'share', only for the plays weighting
+        :type normalization: str
+
+        :param cap: the cap of the 'cap' normalization
+        :type cap: int
+
+        :return: "" for the raw plays, "_listeners", or the normalization, e.g. "_share" or "_cap100"
+        :rtype: str
+    """
+
+    if weighting == 'listeners':
+        if normalization != 'plays':
+            raise ValueError('the normalizations only apply to the plays weighting')
+        return "_listeners"
+
+    if normalization == 'plays':
+        return ""
+    if normalization == 'cap':
+        if cap is None:
+            raise ValueError("the 'cap' normalization needs a cap")
+        return "_cap" + str(cap)
+    return "_" + normalization
+
+
+def weights_name(weighting='plays', normalization='plays', cap=None):
+    """
+        :return: the end of the name of the weights files, e.g. _country_artist, _country_listeners or
+                 _country_artist_cap100
+        :rtype: str
+    """
+
+    if weighting == 'listeners':
+        weights_suffix(weighting, normalization, cap)
+        return "_country_listeners"
+    return "_country_artist" + weights_suffix(weighting, normalization, cap)
+
+
+def run_ingest(args):
+    if args.delta:
+        for file_name in args.delta:
+            with timed('ingest ' + file_name):
+                ingest_delta(file_name, args.update_plays)
+        return
+
+    with timed('user_country'):
+        create_user_country_dict()
+
+    if args.fused:
+        with timed('country_artist (fused)'):
+            create_country_artist_dict_fused(args.processes, args.checkpoint_bytes, args.resume, args.input)
+    elif args.encoded:
+        if args.checkpoint_bytes is not None or args.resume:
+            raise ValueError('checkpoints are not supported for the encoded plays')
+        with timed('plays (encoded)'):
+            create_encoded_plays(args.processes, args.input)
+    else:
+        with timed('plays'):
+            create_plays_dict(args.processes, args.checkpoint_bytes, args.resume, args.input)
+
+
+def run_aggregate(args):
+    with timed('country_artist'):
+        create_country_artist_dict(args.encoded, args.normalization, args.cap)
+
+    if args.listeners:
+        with timed('country_listeners'):
+            create_country_listeners_dict(args.encoded)
+
+
+def run_build_graphs(args):
+    weights = weights_name(args.weighting, args.normalization, args.cap)
+
+    with timed('load'):
+        year_dicts = load_year_dicts(weights, args.years, args.encoded)
+
+    with timed('graphs'):
+        graphs = top_artists_graphs(year_dicts, args.top, args.processes)
+
+    for year in args.years:
+        store_dict_pickle(graph_name(year, args.top, args.weighting, args.normalization, args.cap), graphs[year])
+
+
+def load_year_dicts(weights, years, encoded=False):
+    """
+        Loads the country_artist (or country_listeners) dictionaries of some years
+
+        :param weights: the end of the file names, see weights_name()
+        :type weights: str
+
+        :param years: the years to load
+        :type years: list
+
+        :param encoded: decode the years from the encoded table made by aggregate --encoded instead
+        :type encoded: bool
+
+        :return: dictionary[year][country][artist] = weight
+        :rtype: dict
+    """
+
+    if not encoded:
+        return {year: load_dict_pickle(year + weights) for year in years}
+
+    table = load_dict_pickle(weights[1:] + "_encoded")
+    return {year: table.to_dict(year) for year in years}
+
+
+def run_similarity(args):
+    with timed('load'):
+        names = [graph_name(year, args.top, args.weighting, args.normalization, args.cap) for year in args.years]
+        year_neighborhoods = [graph_neighborhoods(load_dict_pickle(name)) for name in names]
+
+    with timed('jaccard'):
+        similarities = years_jaccard(year_neighborhoods, args.lag)
+
+    with timed('csv'):
+        write_jaccard_csv(similarities, list(args.years), args.output, args.lag)
+
+
+def run_pipeline(args):
+    stages = pipeline_stages(tuple(args.years), args.top, args.weighting, args.output, args.processes, args.input,
+                             args.normalization, args.cap)
+    run_stages(stages, args.processes)
+
+
+def run_report(args):
+    with timed('user countries'):
+        user_countries = count_user_country_dict()
+
+    print('Top %d countries by number of users' % args.top)
+    for country in top_k_dict(user_countries, args.top):
+        print('%s\t%d' % (country, user_countries[country]))
+
+
+def main(argv=None):
+    """
+        Runs one stage of the pipeline, e.g. python parse_music_data.py aggregate --encoded
+
+        The stages are run in this order: ingest, aggregate, build-graphs, similarity. Each one reads what the one
+        before saved in data/dictionary. run does all of them through the cached stages of pipeline_stages(), only
+        running what changed since the last run. report prints the countries with the most users.
+
+        :param argv: the command line arguments, sys.argv when None
+        :type argv: list
+    """
+
+    parser = argparse.ArgumentParser(description="Builds the last.fm country-artist data sets, graphs and Jaccard "
+                                                 "similarities.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    ingest = commands.add_parser('ingest', help="read the tsv files into the user_country and plays dictionaries")
+    ingest.add_argument('--processes', type=int, default=1)
+    ingest.add_argument('--fused', action='store_true',
+                        help="make the country_artist dictionaries straight from user_track.tsv, without plays")
+    ingest.add_argument('--encoded', action='store_true',
+                        help="count the plays straight into integer id arrays (plays_encoded) instead of plays")
+    ingest.add_argument('--checkpoint-bytes', type=int, default=None)
+    ingest.add_argument('--resume', action='store_true')
+    ingest.add_argument('--input', default=USER_TRACK_FILE, metavar='FILE',
+                        help="the user_track file to read, it can be compressed (.gz, .bz2 or .xz)")
+    ingest.add_argument('--delta', nargs='+', metavar='FILE',
+                        help="only add the new rows of these user_track files to the country_artist dictionaries")
+    ingest.add_argument('--update-plays', action='store_true',
+                        help="with --delta, also add the new rows to plays and plays_encoded, rewriting them whole")
+    ingest.set_defaults(run=run_ingest)
+
+    aggregate = commands.add_parser('aggregate', help="add up the plays dictionary by country for every year")
+    aggregate.add_argument('--encoded', action='store_true',
+                           help="join the encoded plays and save id arrays instead of dictionaries")
+    aggregate.add_argument('--normalization', choices=NORMALIZATIONS, default='plays')
+    aggregate.add_argument('--cap', type=int, default=None)
+    aggregate.add_argument('--listeners', action='store_true', help="also count the distinct listeners")
+    aggregate.set_defaults(run=run_aggregate)
 
+    for name, run, help_text in (('build-graphs', run_build_graphs, "make the top artists graph of every year"),
+                                 ('similarity', run_similarity, "write the Jaccard similarities of the graphs")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--years', nargs='+', default=YEARS)
+        command.add_argument('--top', type=int, default=5, help="the number of top artists of every country")
+        command.add_argument('--weighting', choices=('plays', 'listeners'), default='plays')
+        command.add_argument('--normalization', choices=NORMALIZATIONS, default='plays',
+                             help="use the plays normalized by aggregate --normalization")
+        command.add_argument('--cap', type=int, default=None)
+        command.set_defaults(run=run)
+    commands.choices['build-graphs'].add_argument('--processes', type=int, default=1,
+                                                  help="the number of years made at the same time")
+    commands.choices['build-graphs'].add_argument('--encoded', action='store_true',
+                                                  help="read the weights saved by aggregate --encoded")
+    commands.choices['similarity'].add_argument('--output', default=JACCARD_FILE)
+    commands.choices['similarity'].add_argument('--lag', type=int, default=1, help="how many years apart the compared "
+                                                                                  "years are")
 
-    return country
+    pipeline = commands.add_parser('run', help="run every stage that is out of date, keeping the results in the "
+                                               "data/cache directory")
+    pipeline.add_argument('--years', nargs='+', default=YEARS)
+    pipeline.add_argument('--top', type=int, default=5)
+    pipeline.add_argument('--weighting', choices=('plays', 'listeners'), default='plays')
+    pipeline.add_argument('--normalization', choices=NORMALIZATIONS, default='plays')
+    pipeline.add_argument('--cap', type=int, default=None)
+    pipeline.add_argument('--processes', type=int, default=1)
+    pipeline.add_argument('--output', default=JACCARD_FILE)
+    pipeline.add_argument('--input', default=USER_TRACK_FILE, metavar='FILE',
+                          help="the user_track file to read, it can be compressed (.gz, .bz2 or .xz)")
+    pipeline.set_defaults(run=run_pipeline)
 
-x = count_user_country_dict()
-for i in range(10):
-    max_country = max(x.keys(), key=(lambda k: x[k]))
-    print(max_country)
-    x.pop(max_country)
+    report = commands.add_parser('report', help="print the countries with the most users")
+    report.add_argument('--top', type=int, default=10)
+    report.set_defaults(run=run_report)
 
+    args = parser.parse_args(argv)
+    with timed(args.command):
+        args.run(args)
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+    The locations of the data files.
+
+    Every path is built from the data folder next to src, found from where this file is, so the scripts work from
+    any working directory and not only from src.
+"""
+
+import os
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+DICTIONARY_DIRECTORY = os.path.join(DATA_DIRECTORY, 'dictionary')
+TSV_DIRECTORY = os.path.join(DATA_DIRECTORY, 'tsv')
+CACHE_DIRECTORY = os.path.join(DATA_DIRECTORY, 'cache')
+
+USER_TRACK_FILE = os.path.join(TSV_DIRECTORY, 'user_track.tsv')
+PROFILE_FILE = os.path.join(TSV_DIRECTORY, 'userid-profile.tsv')
+JACCARD_FILE = os.path.join(DATA_DIRECTORY, 'jaccard_indexes.csv')
+
+
+def dictionary_path(file_name, extension='.pkl'):
+    """
+        :param file_name: the name of a file in the dictionary folder without the extension, e.g. 2008_country_artist
+        :type file_name: str
+
+        :return: the full path of the file
+        :rtype: str
+    """
+
+    return os.path.join(DICTIONARY_DIRECTORY, file_name + extension)
@@ -0,0 +1,278 @@
+"""
+    A small stage runner with a content-addressed artifact cache.
+
+    A Stage is one step of the pipeline, e.g. the 2008 country_artist dictionary or the 2008 top artists graph. Its
+    key is a hash of its name, its parameters, the contents of the raw files it reads and the keys of the stages it
+    uses. Each result is saved in the cache directory under its key, so a stage is only run again when something that
+    went into it changed, and switching a parameter back finds the earlier result again.
+
+    run_stages() runs the stages in dependency order. Stages that don't depend on each other (the years of the
+    aggregation and of the graphs) are run at the same time in a process pool. The manifest pickle in the cache
+    directory records what every stage was last made from.
+
+    The stages of the last.fm pipeline are defined in parse_music_data.py, see pipeline_stages().
+"""
+
+import hashlib
+import os
+import pickle
+import time
+from multiprocessing import Pool
+
+from paths import CACHE_DIRECTORY
+
+
+class Stage:
+    """
+        One step of the pipeline
+
+        run(*input_results, **params) makes the result from the results of the input stages, in the order they are
+        listed. run has to be a module level function (or a functools.partial of one) so it can be run in a worker
+        process. Anything passed through a partial isn't part of the key, which is what settings like the number of
+        processes that don't change the result are for.
+    """
+
+    def __init__(self, name, run, inputs=(), params=None, files=(), outputs=(), in_process=False):
+        """
+            :param name: the unique name of the stage, e.g. 2008_country_artist
+            :type name: str
+
+            :param inputs: the names of the stages whose results are passed to run
+            :type inputs: tuple
+
+            :param params: the keyword arguments of run, they are part of the key
+            :type params: dict
+
+            :param files: the raw files the stage reads, their contents are part of the key
+            :type files: tuple
+
+            :param outputs: files the stage writes outside the cache, it is run again if one is missing
+            :type outputs: tuple
+
+            :param in_process: always run the stage in this process, for stages that start a pool of their own
+            :type in_process: bool
+        """
+
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.params = params or dict()
+        self.files = tuple(files)
+        self.outputs = tuple(outputs)
+        self.in_process = in_process
+
+
+class ArtifactCache:
+    """
+        Stage results saved as pickle files named by their key
+    """
+
+    def __init__(self, directory=CACHE_DIRECTORY):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        # content hashes of the raw files by (path, size, modification time), so a large file is only read again
+        # when it changed
+        self.fingerprints = self.load_pickle('fingerprints', dict())
+        self.manifest = self.load_pickle('manifest', dict())
+
+    def path(self, name, key):
+        return os.path.join(self.directory, name + '-' + key[:20] + '.pkl')
+
+    def file_hash(self, file_name):
+        """
+            :return: the sha256 hash of a file's contents
+            :rtype: str
+        """
+
+        status = os.stat(file_name)
+        stamp = (os.path.abspath(file_name), status.st_size, status.st_mtime_ns)
+        if stamp not in self.fingerprints:
+            digest = hashlib.sha256()
+            with open(file_name, 'rb') as file_in:
+                for block in iter(lambda: file_in.read(1 << 20), b''):
+                    digest.update(block)
+            self.fingerprints[stamp] = digest.hexdigest()
+
+        return self.fingerprints[stamp]
+
+    def stage_key(self, stage, input_keys):
+        """
+            Hashes everything that goes into a stage
+
+            :param input_keys: the keys of the stage's input stages, in order
+            :type input_keys: list
+
+            :rtype: str
+        """
+
+        digest = hashlib.sha256()
+        digest.update(repr((stage.name, sorted(stage.params.items()), input_keys,
+                            [self.file_hash(file_name) for file_name in stage.files])).encode('utf8'))
+        return digest.hexdigest()
+
+    def is_current(self, stage, key):
+        if not os.path.exists(self.path(stage.name, key)):
+            return False
+        if not stage.outputs:
+            return True
+
+        # files outside the cache are overwritten by runs with other parameters, so they are only current if this key
+        # was the last to write them
+        last_run = self.manifest.get(stage.name, dict()).get('key')
+        return last_run == key and all(os.path.exists(output) for output in stage.outputs)
+
+    def load(self, name, key):
+        with open(self.path(name, key), 'rb') as f:
+            return pickle.load(f)
+
+    def record(self, stage, key, input_keys):
+        self.manifest[stage.name] = {'key': key, 'params': stage.params, 'inputs': dict(zip(stage.inputs, input_keys)),
+                                     'files': {file_name: self.file_hash(file_name) for file_name in stage.files}}
+
+    def save_state(self):
+        store_pickle(os.path.join(self.directory, 'fingerprints.pkl'), self.fingerprints)
+        store_pickle(os.path.join(self.directory, 'manifest.pkl'), self.manifest)
+
+    def load_pickle(self, name, default):
+        try:
+            with open(os.path.join(self.directory, name + '.pkl'), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return default
+
+
+def store_pickle(path, value):
+    # write to a temporary file first so a crash while writing never leaves a broken pickle behind
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def run_stage(stage, input_paths, output_path):
+    """
+        Runs one stage on the cached results of its inputs and saves its result, in this or a worker process
+
+        :return: the number of seconds the stage took
+        :rtype: float
+    """
+
+    start = time.perf_counter()
+
+    inputs = list()
+    for path in input_paths:
+        with open(path, 'rb') as f:
+            inputs.append(pickle.load(f))
+
+    store_pickle(output_path, stage.run(*inputs, **stage.params))
+    return time.perf_counter() - start
+
+
+def stage_order(stages):
+    """
+        Sorts the stages so every stage comes after its inputs
+
+        :param stages: dictionary[name] = Stage
+        :type stages: dict
+
+        :rtype: list
+    """
+
+    order = list()
+    visiting = set()
+    done = set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError('the stages have a dependency cycle at ' + name)
+        if name not in stages:
+            raise ValueError('unknown stage: ' + name)
+
+        visiting.add(name)
+        for input_name in stages[name].inputs:
+            visit(input_name)
+        visiting.remove(name)
+
+        done.add(name)
+        order.append(stages[name])
+
+    for name in stages:
+        visit(name)
+
+    return order
+
+
+def run_stages(stages, processes=1, cache=None, targets=None):
+    """
+        Runs the stages that aren't up to date and returns the result of every target stage
+
+        The stages run in waves: each wave is every stage whose inputs are done, and the stages of a wave are run in a
+        pool of processes. Stages marked in_process, and a wave of a single stage, run in this process instead.
+
+        :param stages: the stages of the pipeline
+        :type stages: list
+
+        :param processes: the number of stages run at the same time
+        :type processes: int
+
+        :param cache: the cache to use, the default cache directory if None
+        :type cache: ArtifactCache
+
+        :param targets: the names of the stages whose results are returned, every stage without dependents if None
+        :type targets: list
+
+        :return: dictionary[name] = result
+        :rtype: dict
+    """
+
+    stages = {stage.name: stage for stage in stages}
+    if cache is None:
+        cache = ArtifactCache()
+    if targets is None:
+        used = {name for stage in stages.values() for name in stage.inputs}
+        targets = [name for name in stages if name not in used]
+
+    # ------------ Hash every stage, inputs first
+    keys = dict()
+    input_keys = dict()
+    pending = list()
+    for stage in stage_order(stages):
+        input_keys[stage.name] = [keys[name] for name in stage.inputs]
+        keys[stage.name] = cache.stage_key(stage, input_keys[stage.name])
+
+        if cache.is_current(stage, keys[stage.name]):
+            print('%s: up to date' % stage.name)
+        else:
+            pending.append(stage)
+
+    # ------------ Run the stages that changed, the independent ones at the same time
+    running = {stage.name for stage in pending}
+    pool = Pool(processes) if processes > 1 and len(pending) > 1 else None
+    try:
+        while pending:
+            wave = [stage for stage in pending if not running.intersection(stage.inputs)]
+            jobs = [(stage, [cache.path(name, keys[name]) for name in stage.inputs],
+                     cache.path(stage.name, keys[stage.name])) for stage in wave]
+
+            # start the pooled stages first so they run while the in process ones do
+            pooled = [job for job in jobs if pool is not None and len(wave) > 1 and not job[0].in_process]
+            results = pool.starmap_async(run_stage, pooled) if pooled else None
+            seconds = {job[0].name: run_stage(*job) for job in jobs if job not in pooled}
+            if results is not None:
+                seconds.update(zip((job[0].name for job in pooled), results.get()))
+
+            for stage in wave:
+                print('%s: %.2fs' % (stage.name, seconds[stage.name]))
+                cache.record(stage, keys[stage.name], input_keys[stage.name])
+                running.remove(stage.name)
+                pending.remove(stage)
+            cache.save_state()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    cache.save_state()
+    return {name: cache.load(name, keys[name]) for name in targets}
@@ -0,0 +1,187 @@
+"""
+    Typed column table of the last.fm user profiles.
+
+    userid-profile.tsv has one row per user with the gender, age, country and registration date. read_profile_tsv()
+    parses it once into numpy columns: gender and country as integer codes into a list of categories, age as an
+    integer and the registration date as a numpy date. The parser caches the table (see load_profile_table() in
+    parse_music_data.py), so every stage and any demographic filter works on the columns instead of reading the tsv
+    file again.
+"""
+
+import csv
+import datetime
+
+import numpy as np
+
+from vocabulary import Vocabulary
+
+MISSING = -1
+
+
+class ProfileTable:
+    """
+        The user profiles as columns, row i of every column is the same user
+    """
+
+    def __init__(self, user_ids, genders, gender_codes, ages, countries, country_codes, registered):
+        """
+            :param user_ids: the user id of every row
+            :type user_ids: list
+
+            :param genders: the gender categories, gender_codes are indexes into it
+            :type genders: Vocabulary
+
+            :param ages: the age of every user, MISSING when not given
+            :type ages: numpy.ndarray
+
+            :param countries: the country categories, country_codes are indexes into it or MISSING
+            :type countries: Vocabulary
+
+            :param registered: the registration date of every user, NaT when not given
+            :type registered: numpy.ndarray
+        """
+
+        self.user_ids = user_ids
+        self.genders = genders
+        self.gender_codes = gender_codes
+        self.ages = ages
+        self.countries = countries
+        self.country_codes = country_codes
+        self.registered = registered
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def mask(self, gender=None, min_age=None, max_age=None, countries=None, registered_from=None,
+             registered_to=None):
+        """
+            Selects the users that match every given filter, filters that aren't given match everyone
+
+            Users with a missing age or registration date don't match a filter on it.
+
+            :param gender: e.g. 'f' or 'm'
+            :type gender: str
+
+            :param countries: the countries to keep
+            :type countries: iterable
+
+            :param registered_from: the first registration date to keep, e.g. '2006-01-01'
+            :type registered_from: str
+
+            :return: bool array with one value per user
+            :rtype: numpy.ndarray
+        """
+
+        selected = np.ones(len(self), dtype=bool)
+
+        if gender is not None:
+            selected &= self.gender_codes == self.genders.get(gender)
+        if min_age is not None:
+            selected &= (self.ages != MISSING) & (self.ages >= min_age)
+        if max_age is not None:
+            selected &= (self.ages != MISSING) & (self.ages <= max_age)
+        if countries is not None:
+            codes = [self.countries.get(country) for country in countries]
+            selected &= np.isin(self.country_codes, [code for code in codes if code != MISSING])
+        if registered_from is not None:
+            selected &= self.registered >= np.datetime64(registered_from, 'D')
+        if registered_to is not None:
+            selected &= self.registered <= np.datetime64(registered_to, 'D')
+
+        return selected
+
+    def users(self, selected=None):
+        """
+            :return: the user ids of the selected rows, all of them when no mask is given
+            :rtype: list
+        """
+
+        if selected is None:
+            return list(self.user_ids)
+        return [self.user_ids[i] for i in np.flatnonzero(selected)]
+
+    def user_country(self, selected=None):
+        """
+            Maps the users that have a country to it, the same dictionary as the user_country pickle
+
+            :param selected: bool array from mask() to only keep some users
+            :type selected: numpy.ndarray
+
+            :return: dictionary[user_id] = country
+            :rtype: dict
+        """
+
+        has_country = self.country_codes != MISSING
+        if selected is not None:
+            has_country &= selected
+
+        return {self.user_ids[i]: self.countries.word(self.country_codes[i]) for i in np.flatnonzero(has_country)}
+
+    def country_counts(self, selected=None):
+        """
+            Counts the users of every country
+
+            :return: dictionary[country] = number of users, countries in the order they first appear in the file
+            :rtype: dict
+        """
+
+        codes = self.country_codes if selected is None else self.country_codes[selected]
+        counts = np.bincount(codes[codes != MISSING], minlength=len(self.countries))
+        return {country: int(counts[code]) for code, country in enumerate(self.countries) if counts[code]}
+
+
+def read_profile_tsv(file_name):
+    """
+        Reads userid-profile.tsv into a ProfileTable
+
+        :param file_name: the path of the profile tsv file
+        :type file_name: str
+
+        :rtype: ProfileTable
+    """
+
+    user_ids = list()
+    genders = Vocabulary()
+    gender_codes = list()
+    ages = list()
+    countries = Vocabulary()
+    country_codes = list()
+    registered = list()
+
+    with open(file_name, 'r', encoding="utf8") as file_in:
+        reader = csv.reader(file_in, delimiter='\t')
+
+        # skipping first row with headers
+        next(reader)
+
+        for row in reader:
+            '''
+                row[0] = user id
+                row[1] = gender
+                row[2] = age
+                row[3] = country
+                row[4] = registered, e.g. Aug 13, 2006
+            '''
+            user_ids.append(row[0])
+            gender_codes.append(genders.id(row[1]))
+            ages.append(int(row[2]) if row[2] != '' else MISSING)
+            country_codes.append(countries.id(row[3]) if row[3] != '' else MISSING)
+            registered.append(parse_registered(row[4]))
+
+    return ProfileTable(user_ids,
+                        genders, np.array(gender_codes, dtype=np.int8),
+                        np.array(ages, dtype=np.int16),
+                        countries, np.array(country_codes, dtype=np.int16),
+                        np.array(registered, dtype='datetime64[D]'))
+
+
+def parse_registered(text):
+    """
+        :return: the date in the registered column, or NaT if it is empty or can't be read
+        :rtype: numpy.datetime64
+    """
+
+    try:
+        return np.datetime64(datetime.datetime.strptime(text, '%b %d, %Y').date(), 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
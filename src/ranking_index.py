@@ -0,0 +1,164 @@
+"""
+    Per country ranking of artists by play count.
+
+    The country_artist dictionaries have to be scanned again every time a different number of top artists is needed.
+    A RankingIndex sorts each country's artists once and keeps them as two arrays (artist ids and play counts, from
+    most to least played), so the top N artists of a country are the first N entries for any N and the rank of an
+    artist is its position in the array.
+
+    Ties keep the order of the dictionary, the same as top_k.top_k_dict(), so a slice of the index gives the same
+    artists as selecting them from the dictionary. Since the counts are sorted, the number of artists above a play
+    count threshold is a binary search.
+"""
+
+import numpy as np
+
+from vocabulary import ID_TYPE, Vocabulary, count_type
+
+
+class RankingIndex:
+    """
+        The artists of every country in one year's country_artist dictionary, sorted by play count
+    """
+
+    def __init__(self, country_artist, artists=None):
+        """
+            :param country_artist: dictionary[country][artist] = artist_play_count for one year, the counts can be
+                                   float weights like the 'share' normalization makes
+            :type country_artist: dict
+
+            :param artists: artist vocabulary to use, pass the same one to every year so the ids can be compared
+            :type artists: Vocabulary
+        """
+
+        if artists is None:
+            artists = Vocabulary()
+
+        self.artists = artists
+        self.rankings = dict()
+        self.totals = dict()
+
+        for country in country_artist:
+            artist_ids = np.fromiter((artists.id(artist) for artist in country_artist[country]),
+                                     dtype=ID_TYPE, count=len(country_artist[country]))
+            values = country_artist[country].values()
+            counts = np.fromiter(values, dtype=count_type(values), count=len(artist_ids))
+
+            # stable sort from most to least played so ties stay in dictionary order
+            order = np.argsort(-counts, kind='stable')
+            self.rankings[country] = (artist_ids[order], counts[order])
+            self.totals[country] = counts.sum().item()
+
+    def __len__(self):
+        return len(self.rankings)
+
+    def __iter__(self):
+        return iter(self.rankings)
+
+    def __contains__(self, country):
+        return country in self.rankings
+
+    def size(self, country):
+        """
+            :return: the number of artists played in the country
+            :rtype: int
+        """
+
+        return len(self.rankings[country][0])
+
+    def artist_ids(self, country):
+        """
+            :return: the artist ids of the country from most to least played
+            :rtype: numpy.ndarray
+        """
+
+        return self.rankings[country][0]
+
+    def counts(self, country):
+        """
+            :return: the play counts of the country from largest to smallest
+            :rtype: numpy.ndarray
+        """
+
+        return self.rankings[country][1]
+
+    def total(self, country):
+        """
+            :return: the play count of all the artists of the country
+            :rtype: int
+        """
+
+        return self.totals[country]
+
+    def count_at_least(self, country, min_count):
+        """
+            Counts the artists of a country played at least min_count times with a binary search of the sorted counts
+
+            :rtype: int
+        """
+
+        # the reversed view of the descending counts is ascending, the artists below min_count are at its start
+        counts = self.rankings[country][1]
+        return int(len(counts) - np.searchsorted(counts[::-1], min_count, side='left'))
+
+    def top_ids(self, country, top_number):
+        """
+            Gets the top artists of a country as arrays
+
+            :return: (artist_ids, counts) of at most top_number artists
+            :rtype: tuple
+        """
+
+        artist_ids, counts = self.rankings[country]
+        return artist_ids[:top_number], counts[:top_number]
+
+    def top(self, country, top_number):
+        """
+            Gets the top artists of a country
+
+            :return: list of (artist, play_count) from most to least played, at most top_number long
+            :rtype: list
+        """
+
+        artist_ids, counts = self.top_ids(country, top_number)
+        return [(self.artists.word(i), count) for i, count in zip(artist_ids.tolist(), counts.tolist())]
+
+    def neighborhoods(self, top_number):
+        """
+            Gets the top artists of every country that has at least top_number artists, like the top artists graphs
+
+            :return: dictionary[country] = set of the top artist ids
+            :rtype: dict
+        """
+
+        return {country: set(self.rankings[country][0][:top_number].tolist())
+                for country in self.rankings if self.size(country) >= top_number}
+
+    def rank(self, country, artist):
+        """
+            Gets the position of an artist in a country's ranking
+
+            :return: 0 for the most played artist, or -1 if the artist wasn't played in the country
+            :rtype: int
+        """
+
+        artist_id = self.artists.get(artist)
+        positions = np.flatnonzero(self.rankings[country][0] == artist_id)
+        if len(positions) == 0:
+            return -1
+        return int(positions[0])
+
+
+def ranking_indexes(year_dicts):
+    """
+        Makes a RankingIndex for every year with one artist vocabulary shared by all of them
+
+        :param year_dicts: dictionary[year] = country_artist dictionary for that year
+        :type year_dicts: dict
+
+        :return: dictionary[year] = RankingIndex
+        :rtype: dict
+    """
+
+    artists = Vocabulary()
+    return {year: RankingIndex(year_dicts[year], artists) for year in year_dicts}
@@ -0,0 +1,326 @@
+"""
+    Jaccard similarity between the artist neighborhoods of countries.
+
+    A neighborhood is the set of artists a country is connected to in a top artists graph. jaccard() compares two
+    neighborhoods with Python sets. year_pair_jaccard() compares every country across every pair of years at once:
+    each year's neighborhoods are packed into a bitset matrix (one row per country, one bit per artist), so the
+    intersections and unions of all countries are bitwise and/or over whole rows followed by a popcount.
+
+    year_similarity_matrices() compares every country with every other country in the same year. The neighborhoods
+    are a sparse country-artist incidence matrix and the intersections of all pairs are the product of the matrix with
+    its transpose, done a block of rows at a time so memory stays bounded.
+"""
+
+import csv
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sparse
+
+from vocabulary import Vocabulary
+
+# number of set bits in every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# the most recent results of year_pair_jaccard() by their neighborhoods, least recently used first
+YEAR_PAIR_CACHE_SIZE = 8
+year_pair_cache = OrderedDict()
+
+
+def jaccard(neighborhood1, neighborhood2):
+    """
+        J(A,B) = |A n B| / |A U B|
+        A n B = elements in A AND B
+        A U B = elments in A OR B
+
+        :param neighborhood1: the artists of the first country, any iterable (list, set, networkx neighbor iterator)
+        :param neighborhood2: the artists of the second country
+
+        :return: the Jaccard index, 0 when both neighborhoods are empty
+        :rtype: float
+    """
+
+    set1 = set(neighborhood1)
+    set2 = set(neighborhood2)
+
+    union = len(set1 | set2)
+    if union == 0:
+        return 0.0
+
+    return len(set1 & set2) / union
+
+
+def graph_neighborhoods(G):
+    """
+        Gets the neighborhood of every country node in a top artists graph
+
+        :param G: graph with a 'country' attribute on the country nodes
+        :type G: networkx.Graph
+
+        :return: dictionary[country] = set of artists, in the order the countries were added to the graph
+        :rtype: dict
+    """
+
+    return {node: set(G.neighbors(node)) for node, data in G.nodes(data=True) if data.get('country')}
+
+
+def encode_neighborhoods(year_neighborhoods, countries, artists):
+    """
+        Gives every country and artist in the neighborhoods an id
+
+        Everything is encoded before any matrix is made so all the years can have the same shape.
+
+        :return: list of (rows, columns, country_ids) for each year, where (rows[i], columns[i]) is a country-artist
+                 link and country_ids are the countries in that year
+        :rtype: list
+    """
+
+    encoded = list()
+    for neighborhoods in year_neighborhoods:
+        rows = list()
+        columns = list()
+        for country in neighborhoods:
+            country_id = countries.id(country)
+            for artist in neighborhoods[country]:
+                rows.append(country_id)
+                columns.append(artists.id(artist))
+        encoded.append((rows, columns, [countries.get(country) for country in neighborhoods]))
+
+    return encoded
+
+
+def neighborhood_bitsets(year_neighborhoods, countries=None, artists=None):
+    """
+        Packs the neighborhoods of every year into bitset matrices that share a country and artist vocabulary
+
+        :param year_neighborhoods: list of dictionary[country] = set of artists, one for each year
+        :type year_neighborhoods: list
+
+        :return: (bitsets, present, countries, artists) where bitsets[i] is a uint8 array with one row per country
+                 and one bit per artist for year i, and present[i] is a bool array of the countries in year i
+        :rtype: tuple
+    """
+
+    if countries is None:
+        countries = Vocabulary()
+    if artists is None:
+        artists = Vocabulary()
+
+    encoded = encode_neighborhoods(year_neighborhoods, countries, artists)
+
+    bitsets = list()
+    present = list()
+    for rows, columns, country_ids in encoded:
+        incidence = np.zeros((len(countries), max(len(artists), 1)), dtype=bool)
+        incidence[rows, columns] = True
+        bitsets.append(np.packbits(incidence, axis=1))
+
+        in_year = np.zeros(len(countries), dtype=bool)
+        in_year[country_ids] = True
+        present.append(in_year)
+
+    return bitsets, present, countries, artists
+
+
+def bitset_jaccard(bitset1, bitset2):
+    """
+        Gets the Jaccard index of every row of two bitset matrices, the arrays are broadcast against each other
+
+        :return: float array with one index per row, 0 for rows that are empty in both
+        :rtype: numpy.ndarray
+    """
+
+    intersection = POPCOUNT[bitset1 & bitset2].sum(axis=-1, dtype=np.int64)
+    union = POPCOUNT[bitset1 | bitset2].sum(axis=-1, dtype=np.int64)
+
+    return np.divide(intersection, union, out=np.zeros(union.shape), where=union > 0)
+
+
+def year_pair_jaccard(year_neighborhoods):
+    """
+        Gets the Jaccard similarity of every country between every pair of years, not only consecutive ones
+
+        Each year is compared with all the years at once on the stacked bitset matrices. The last YEAR_PAIR_CACHE_SIZE
+        results are kept in memory and returned again when the same neighborhoods are passed, so charts over different
+        year lags don't recompute them. The returned array is read only since it is shared with the cache.
+
+        :param year_neighborhoods: list of dictionary[country] = set of artists, in year order
+        :type year_neighborhoods: list
+
+        :return: (similarities, countries) where similarities[country_id, i, j] is the index between years i and j,
+                 -1 where the country is missing from either year
+        :rtype: tuple
+    """
+
+    key = tuple(frozenset((country, frozenset(neighborhoods[country])) for country in neighborhoods)
+                for neighborhoods in year_neighborhoods)
+    if key in year_pair_cache:
+        year_pair_cache.move_to_end(key)
+        return year_pair_cache[key]
+
+    bitsets, present, countries, artists = neighborhood_bitsets(year_neighborhoods)
+    bitsets = np.stack(bitsets)
+    present = np.stack(present)
+
+    number_of_years = len(year_neighborhoods)
+    similarities = np.full((len(countries), number_of_years, number_of_years), -1.0)
+
+    for i in range(number_of_years):
+        # compare year i with every year at once, shape (years, countries)
+        indexes = bitset_jaccard(bitsets[i], bitsets)
+        both = present[i] & present
+        similarities[:, i, :] = np.where(both, indexes, -1).T
+
+    similarities.flags.writeable = False
+    year_pair_cache[key] = (similarities, countries)
+    if len(year_pair_cache) > YEAR_PAIR_CACHE_SIZE:
+        year_pair_cache.popitem(last=False)
+
+    return similarities, countries
+
+
+def years_jaccard(year_neighborhoods, lag=1):
+    """
+        Gets the Jaccard similarity of every country between years that are lag apart, consecutive years by default
+
+        :param year_neighborhoods: list of dictionary[country] = set of artists, in year order
+        :type year_neighborhoods: list
+
+        :param lag: how many years apart the compared years are
+        :type lag: int
+
+        :return: dictionary[country] = list of the indexes for each pair of years, -1 where the country is missing
+                 from either year. Countries are in the order they first appear.
+        :rtype: dict
+    """
+
+    similarities, countries = year_pair_jaccard(year_neighborhoods)
+
+    results = dict()
+    for country_id, country in enumerate(countries):
+        row = similarities[country_id]
+        indexes = [row[i, i + lag] for i in range(len(year_neighborhoods) - lag)]
+        # keep missing values as the integer -1 like the CSV file
+        results[country] = [-1 if index == -1 else index for index in map(float, indexes)]
+
+    return results
+
+
+def write_jaccard_csv(similarities, year_labels, file_name, lag=1):
+    """
+        Writes the result of years_jaccard() to a CSV file with one column for each pair of years lag apart
+
+        :param similarities: dictionary[country] = list of the indexes for each pair of years
+        :type similarities: dict
+
+        :param year_labels: the label of every year, e.g. ['2005', '2006']
+        :type year_labels: list
+
+        :param file_name: the path of the CSV file
+        :type file_name: str
+
+        :param lag: the lag years_jaccard() was called with, consecutive years by default
+        :type lag: int
+    """
+
+    with open(file_name, 'w', newline='') as file_out:
+        writer = csv.writer(file_out)
+
+        # make header row, one column for each pair of years
+        writer.writerow(['Country'] + [year_labels[i] + '-' + year_labels[i + lag]
+                                       for i in range(len(year_labels) - lag)])
+
+        for country in similarities:
+            writer.writerow([country] + list(similarities[country]))
+
+
+def clear_year_pair_cache():
+    year_pair_cache.clear()
+
+
+def pairwise_similarity(matrix, metric='jaccard', block_size=1024):
+    """
+        Compares every row of a country-artist matrix with every other row
+
+        The intersections (or dot products) of all pairs are computed as matrix @ matrix.T, block_size rows at a
+        time, so only one block of products is dense at once besides the result.
+
+        :param matrix: sparse matrix with one row per country and one column per artist, either 0/1 links or counts
+        :type matrix: scipy.sparse.spmatrix
+
+        :param metric: 'jaccard' treats every nonzero entry as a link, 'cosine' uses the values as weights
+        :type metric: str
+
+        :param block_size: the number of rows compared at once
+        :type block_size: int
+
+        :return: dense array where [i, j] is the similarity of rows i and j, 0 when either row is empty
+        :rtype: numpy.ndarray
+    """
+
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+    matrix.eliminate_zeros()
+
+    if metric == 'jaccard':
+        matrix.data[:] = 1
+        sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    elif metric == 'cosine':
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    else:
+        raise ValueError('unknown similarity metric: ' + metric)
+
+    number_of_rows = matrix.shape[0]
+    transposed = matrix.T.tocsr()
+    result = np.zeros((number_of_rows, number_of_rows))
+
+    for start in range(0, number_of_rows, block_size):
+        end = min(start + block_size, number_of_rows)
+        products = (matrix[start:end] @ transposed).toarray()
+
+        if metric == 'jaccard':
+            denominators = sizes[start:end, None] + sizes[None, :] - products
+        else:
+            denominators = norms[start:end, None] * norms[None, :]
+
+        np.divide(products, denominators, out=result[start:end], where=denominators > 0)
+
+    return result
+
+
+def year_similarity_matrices(year_neighborhoods, metric='jaccard', block_size=1024):
+    """
+        Gets a country x country similarity matrix for every year
+
+        All the matrices use the same country order, so [i, j] is the same pair of countries in every year.
+
+        :param year_neighborhoods: list of dictionary[country] = set of artists, in year order
+        :type year_neighborhoods: list
+
+        :param metric: 'jaccard' or 'cosine', see pairwise_similarity()
+        :type metric: str
+
+        :param block_size: the number of countries compared at once
+        :type block_size: int
+
+        :return: (matrices, countries) where matrices[i] is the dense similarity array of year i. Pairs where either
+                 country is missing from the year are -1.
+        :rtype: tuple
+    """
+
+    countries = Vocabulary()
+    artists = Vocabulary()
+    encoded = encode_neighborhoods(year_neighborhoods, countries, artists)
+    shape = (len(countries), len(artists))
+
+    matrices = list()
+    for rows, columns, country_ids in encoded:
+        incidence = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=shape)
+        similarities = pairwise_similarity(incidence, metric, block_size)
+
+        missing = np.ones(len(countries), dtype=bool)
+        missing[country_ids] = False
+        similarities[missing, :] = -1
+        similarities[:, missing] = -1
+        matrices.append(similarities)
+
+    return matrices, countries
@@ -0,0 +1,335 @@
+"""
+    Streaming summaries that are built while the user_track data set is read.
+
+    SpaceSaving keeps the heavy hitters of a stream (the most played artists of a country) in a fixed number of
+    counters, however many artists show up. Every reported count is an upper bound of the true count and the error of
+    each counter says how far above the true count it can be, so count - error is a lower bound.
+
+    HyperLogLog estimates the number of distinct items of a stream (the distinct listeners of an artist) in a small,
+    mergeable set of registers. ListenerTable holds one for every (year, country, artist).
+
+    SketchTable and ListenerTable are what the parser fills in, see count_plays_rows() in parse_music_data.py
+"""
+
+import hashlib
+import heapq
+import math
+
+
+class SpaceSaving:
+    """
+        Space-Saving summary of the most frequent items of a stream in at most capacity counters
+
+        When a new item arrives and every counter is in use, the item with the smallest count is replaced and the new
+        item takes over its count (recorded as the new item's error), so counts are never too small.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = dict()
+        self.errors = dict()
+
+        # min heap of (count, item), entries whose count is out of date are skipped when popped
+        self.heap = list()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, item):
+        return item in self.counts
+
+    def add(self, item, count=1):
+        """
+            Adds count occurrences of an item to the summary
+        """
+
+        if item in self.counts:
+            self.counts[item] += count
+            return
+
+        error = 0
+        if len(self.counts) >= self.capacity:
+            # replace the item with the smallest count
+            error = self.min_count()
+            smallest = heapq.heappop(self.heap)[1]
+            del self.counts[smallest]
+            del self.errors[smallest]
+
+        self.counts[item] = error + count
+        self.errors[item] = error
+        heapq.heappush(self.heap, (self.counts[item], item))
+
+    def min_count(self):
+        """
+            :return: the smallest count in the summary, 0 if it isn't full. Any item that isn't in the summary has
+                     been seen at most this many times.
+            :rtype: int
+        """
+
+        if len(self.counts) < self.capacity:
+            return 0
+
+        # bring the heap up to date until its smallest entry has the item's current count
+        while self.heap[0][0] != self.counts[self.heap[0][1]]:
+            item = heapq.heappop(self.heap)[1]
+            heapq.heappush(self.heap, (self.counts[item], item))
+
+        return self.heap[0][0]
+
+    def top(self, k):
+        """
+            Gets the k items with the largest counts
+
+            :return: list of (item, count, error) from largest to smallest count. The true count of each item is
+                     between count - error and count.
+            :rtype: list
+        """
+
+        items = heapq.nlargest(k, self.counts, key=self.counts.__getitem__)
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+    def guaranteed_top(self, k):
+        """
+            Gets the items of top(k) that are certainly in the true top k
+
+            An item is certain when its lower bound is at least the count of the (k+1)th counter, because no other
+            item can have been seen more often than that.
+
+            :rtype: list
+        """
+
+        ranked = self.top(k + 1)
+        if len(ranked) <= k:
+            return ranked[:k]
+
+        bound = max(ranked[k][1], self.min_count())
+        return [entry for entry in ranked[:k] if entry[1] - entry[2] >= bound]
+
+    def merge(self, other):
+        """
+            Adds the counts of another summary with the same capacity to this one
+
+            An item missing from a full summary may have been seen up to that summary's smallest count, so that count is
+            added to the item as error. The result keeps the capacity largest counts.
+        """
+
+        own_min = self.min_count()
+        other_min = other.min_count()
+
+        counts = dict()
+        errors = dict()
+        for item in set(self.counts) | set(other.counts):
+            counts[item] = self.counts.get(item, own_min) + other.counts.get(item, other_min)
+            errors[item] = self.errors.get(item, own_min) + other.errors.get(item, other_min)
+
+        kept = heapq.nlargest(self.capacity, counts, key=counts.__getitem__)
+        self.counts = {item: counts[item] for item in kept}
+        self.errors = {item: errors[item] for item in kept}
+        self.heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+
+class SketchTable:
+    """
+        One summary for every (year, country), made with new_sketch() the first time the pair is seen
+
+        new_sketch has to be picklable (e.g. functools.partial(SpaceSaving, 100)) so tables can be made in worker
+        processes.
+    """
+
+    def __init__(self, new_sketch):
+        self.new_sketch = new_sketch
+        self.sketches = dict()
+
+    def add(self, year, country, item, count=1):
+        """
+            Adds an item to the summary of a (year, country), same arguments as parse_music_data.add_play()
+        """
+
+        if year not in self.sketches:
+            self.sketches[year] = dict()
+        if country not in self.sketches[year]:
+            self.sketches[year][country] = self.new_sketch()
+
+        self.sketches[year][country].add(item, count)
+
+    def merge(self, other):
+        """
+            Merges every summary of another table into this one
+        """
+
+        for year in other.sketches:
+            for country in other.sketches[year]:
+                if year not in self.sketches:
+                    self.sketches[year] = dict()
+                if country in self.sketches[year]:
+                    self.sketches[year][country].merge(other.sketches[year][country])
+                else:
+                    self.sketches[year][country] = other.sketches[year][country]
+
+    def __getitem__(self, year):
+        return self.sketches[year]
+
+    def __iter__(self):
+        return iter(self.sketches)
+
+    def __contains__(self, year):
+        return year in self.sketches
+
+
+class HyperLogLog:
+    """
+        HyperLogLog estimate of the number of distinct items added, e.g. the distinct listeners of an artist
+
+        Registers are kept in a dictionary while few are set and switched to a bytearray of 2**precision registers once
+        that is smaller, so the many artists with a handful of listeners stay cheap. Two sketches with the same precision
+        are merged by taking the largest value of every register. The standard error is about 1.04 / sqrt(2**precision).
+    """
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = dict()
+
+    def add(self, item, count=1):
+        """
+            Adds an item, count is ignored since only distinct items matter
+        """
+
+        # a stable hash so sketches made in different processes can be merged
+        value = int.from_bytes(hashlib.blake2b(str(item).encode('utf8'), digest_size=8).digest(), 'big')
+
+        index = value >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        rank = remaining_bits - (value & ((1 << remaining_bits) - 1)).bit_length() + 1
+
+        if rank > self.register(index):
+            self.set_register(index, rank)
+
+    def register(self, index):
+        if isinstance(self.registers, dict):
+            return self.registers.get(index, 0)
+        return self.registers[index]
+
+    def set_register(self, index, rank):
+        if isinstance(self.registers, dict):
+            self.registers[index] = rank
+            if len(self.registers) > self.size // 4:
+                self.make_dense()
+        else:
+            self.registers[index] = rank
+
+    def make_dense(self):
+        dense = bytearray(self.size)
+        for index, rank in self.registers.items():
+            dense[index] = rank
+        self.registers = dense
+
+    def set_registers(self):
+        """
+            :return: (index, value) of every register that isn't 0
+            :rtype: iterable
+        """
+
+        if isinstance(self.registers, dict):
+            return self.registers.items()
+        return ((index, rank) for index, rank in enumerate(self.registers) if rank)
+
+    def merge(self, other):
+        """
+            Adds the items of another sketch with the same precision to this one
+        """
+
+        if other.precision != self.precision:
+            raise ValueError('only sketches with the same precision can be merged')
+
+        for index, rank in other.set_registers():
+            if rank > self.register(index):
+                self.set_register(index, rank)
+
+    def count(self):
+        """
+            :return: the estimated number of distinct items
+            :rtype: int
+        """
+
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        set_registers = list(self.set_registers())
+        zeros = self.size - len(set_registers)
+
+        estimate = alpha * self.size * self.size / (zeros + sum(2.0 ** -rank for _, rank in set_registers))
+
+        # use linear counting for small numbers of items, where it is more accurate
+        if estimate <= 2.5 * self.size and zeros > 0:
+            estimate = self.size * math.log(self.size / zeros)
+
+        return int(round(estimate))
+
+
+class ListenerTable:
+    """
+        One HyperLogLog of distinct listeners for every (year, country, artist)
+
+        It is filled from rows by user id, the user's country is looked up here so the user id can be added to the
+        sketch. Users without a country are skipped.
+    """
+
+    def __init__(self, user_dict, precision=10):
+        self.user_dict = user_dict
+        self.precision = precision
+        self.sketches = dict()
+
+    def add(self, year, user, artist, count=1):
+        """
+            Adds a listener to an artist, same arguments as parse_music_data.add_play()
+        """
+
+        try:
+            country = self.user_dict[user]
+        except KeyError:
+            return
+
+        if year not in self.sketches:
+            self.sketches[year] = dict()
+        if country not in self.sketches[year]:
+            self.sketches[year][country] = dict()
+        if artist not in self.sketches[year][country]:
+            self.sketches[year][country][artist] = HyperLogLog(self.precision)
+
+        self.sketches[year][country][artist].add(user)
+
+    def merge(self, other):
+        """
+            Merges every sketch of another table into this one
+        """
+
+        for year in other.sketches:
+            for country in other.sketches[year]:
+                for artist, sketch in other.sketches[year][country].items():
+                    if year not in self.sketches:
+                        self.sketches[year] = dict()
+                    if country not in self.sketches[year]:
+                        self.sketches[year][country] = dict()
+
+                    if artist in self.sketches[year][country]:
+                        self.sketches[year][country][artist].merge(sketch)
+                    else:
+                        self.sketches[year][country][artist] = sketch
+
+    def distinct_listeners(self, year):
+        """
+            Gets the estimated number of distinct listeners of every artist in every country for one year
+
+            :return: dictionary[country][artist] = number of listeners, the same form as a country_artist dictionary
+                     so it can be used for the edge weights of the top artists graphs
+            :rtype: dict
+        """
+
+        return {country: {artist: sketch.count() for artist, sketch in self.sketches[year][country].items()}
+                for country in self.sketches[year]}
+
+    def __iter__(self):
+        return iter(self.sketches)
+
+    def __contains__(self, year):
+        return year in self.sketches
@@ -0,0 +1,132 @@
+"""
+    Sparse matrix form of the per year country_artist dictionaries.
+
+    Each year becomes a scipy.sparse CSR matrix with one row per country and one column per artist. All the years share
+    the same country and artist vocabularies, so a column means the same artist in every year and the matrices can be
+    compared or combined row by row without going back to the dictionaries.
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+
+from vocabulary import COUNT_TYPE, WEIGHT_TYPE, Vocabulary, encode_country_artist
+
+
+def country_artist_matrices(year_dicts, countries=None, artists=None):
+    """
+        Makes a CSR matrix of play counts for every year's country_artist dictionary
+
+        :param year_dicts: dictionary[year] = country_artist dictionary for that year
+        :type year_dicts: dict
+
+        :param countries: the country vocabulary to use and add to, a new one is made if not given
+        :type countries: Vocabulary
+
+        :param artists: the artist vocabulary to use and add to, a new one is made if not given
+        :type artists: Vocabulary
+
+        :return: (matrices, countries, artists) where matrices[year] is a CSR matrix of shape
+                 (len(countries), len(artists))
+        :rtype: tuple
+    """
+
+    if countries is None:
+        countries = Vocabulary()
+    if artists is None:
+        artists = Vocabulary()
+
+    # encode every year first so the shape can cover the whole vocabulary
+    encoded = dict()
+    for year in year_dicts:
+        encoded[year] = encode_country_artist(year_dicts[year], countries, artists)
+
+    matrices = dict()
+    for year in encoded:
+        matrices[year] = encoded_to_matrix(encoded[year], (len(countries), len(artists)))
+
+    return matrices, countries, artists
+
+
+def encoded_to_matrix(encoded, shape):
+    """
+        Turns (row_ids, column_ids, counts) arrays into a CSR matrix
+
+        Float counts (the 'share' weights) stay floats, anything else is stored as COUNT_TYPE.
+
+        :return: the CSR matrix of counts
+        :rtype: scipy.sparse.csr_matrix
+    """
+
+    row_ids, column_ids, counts = encoded
+    dtype = WEIGHT_TYPE if np.issubdtype(counts.dtype, np.floating) else COUNT_TYPE
+    matrix = sparse.csr_matrix((counts, (row_ids, column_ids)), shape=shape, dtype=dtype)
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+    return matrix
+
+
+def resize_matrices(matrices, countries, artists):
+    """
+        Grows every matrix to the current size of the vocabularies, for when years are added after they were built
+
+        :return: dictionary[year] = the matrix with any new rows and columns empty
+        :rtype: dict
+    """
+
+    shape = (len(countries), len(artists))
+    resized = dict()
+    for year in matrices:
+        matrix = matrices[year].copy()
+        matrix.resize(shape)
+        resized[year] = matrix
+
+    return resized
+
+
+def matrix_to_dict(matrix, countries, artists):
+    """
+        Turns a country-artist CSR matrix back into a country_artist dictionary
+
+        Countries with no plays in the matrix are left out, like in the dictionaries made by the parser.
+
+        :return: dictionary[country][artist] = artist_play_count
+        :rtype: dict
+    """
+
+    country_artist = dict()
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        if start == end:
+            continue
+
+        country_artist[countries.word(row)] = dict(zip([artists.word(i) for i in matrix.indices[start:end]],
+                                                       matrix.data[start:end].tolist()))
+
+    return country_artist
+
+
+def country_row(matrix, countries, country):
+    """
+        Gets the artist ids and play counts of one country
+
+        :return: (artist_ids, counts) arrays, empty if the country isn't in the matrix
+        :rtype: tuple
+    """
+
+    row = countries.get(country)
+    if row < 0 or row >= matrix.shape[0]:
+        return np.empty(0, dtype=matrix.indices.dtype), np.empty(0, dtype=matrix.data.dtype)
+
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    return matrix.indices[start:end], matrix.data[start:end]
+
+
+def total_plays(matrix):
+    """
+        Gets the total number of plays for every country
+
+        :return: array indexed by country id
+        :rtype: numpy.ndarray
+    """
+
+    return np.asarray(matrix.sum(axis=1)).ravel()
@@ -0,0 +1,160 @@
+"""
+    Country-artist play counts for time buckets smaller than a year.
+
+    The user_track data set is read once with the plays counted by day, country and artist straight into integer id
+    arrays (an EncodedCounts table, see create_time_bucket_counts() in parse_music_data.py). The day counts are then
+    added up into every bucket level: year, quarter, month, ISO week and day. This works on the day totals instead of
+    the rows, so all the levels come from the one scan.
+
+    Each level is stored as a TimeBucketCounts, sorted arrays of (bucket, country id, artist id, count) with a pointer
+    array per bucket, so the country_artist counts of one month are a slice just like the ones of a year.
+"""
+
+import datetime
+
+import numpy as np
+
+from vocabulary import COUNT_TYPE, ID_TYPE
+
+BUCKET_LEVELS = ('year', 'quarter', 'month', 'week', 'day')
+
+
+def bucket_label(day, level):
+    """
+        Gets the label of the bucket a day falls in
+
+        :param day: the day in the format year-month-day, e.g. 2009-05-04
+        :type day: str
+
+        :param level: one of BUCKET_LEVELS
+        :type level: str
+
+        :return: the bucket label, e.g. 2009, 2009-Q2, 2009-05, 2009-W19 or 2009-05-04
+        :rtype: str
+    """
+
+    if level == 'year':
+        return day[:4]
+    if level == 'quarter':
+        return '%s-Q%d' % (day[:4], (int(day[5:7]) - 1) // 3 + 1)
+    if level == 'month':
+        return day[:7]
+    if level == 'week':
+        # ISO weeks can belong to the year before or after the day's calendar year
+        iso_year, iso_week, _ = datetime.date(int(day[:4]), int(day[5:7]), int(day[8:10])).isocalendar()
+        return '%d-W%02d' % (iso_year, iso_week)
+    if level == 'day':
+        return day
+
+    raise ValueError('unknown time bucket level: ' + level)
+
+
+class TimeBucketCounts:
+    """
+        The country-artist play counts of every bucket of one level, e.g. every month
+    """
+
+    def __init__(self, level, labels, bucket_pointers, country_ids, artist_ids, counts, countries, artists):
+        self.level = level
+        self.labels = labels
+        self.bucket_pointers = bucket_pointers
+        self.country_ids = country_ids
+        self.artist_ids = artist_ids
+        self.counts = counts
+        self.countries = countries
+        self.artists = artists
+        self.label_index = {label: i for i, label in enumerate(labels)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __contains__(self, label):
+        return label in self.label_index
+
+    def bucket_arrays(self, label):
+        """
+            Gets the counts of one bucket without copying them
+
+            :return: (country_ids, artist_ids, counts) sorted by country id then artist id
+            :rtype: tuple
+        """
+
+        i = self.label_index[label]
+        start, end = self.bucket_pointers[i], self.bucket_pointers[i + 1]
+        return self.country_ids[start:end], self.artist_ids[start:end], self.counts[start:end]
+
+    def __getitem__(self, label):
+        """
+            Gets the counts of one bucket in the same form as a YYYY_country_artist dictionary
+
+            :return: dictionary[country][artist] = artist_play_count
+            :rtype: dict
+        """
+
+        country_artist = dict()
+        for country_id, artist_id, count in zip(*(array.tolist() for array in self.bucket_arrays(label))):
+            country = self.countries.word(country_id)
+            if country not in country_artist:
+                country_artist[country] = dict()
+            country_artist[country][self.artists.word(artist_id)] = count
+
+        return country_artist
+
+    def between(self, first, last):
+        """
+            :return: the labels of the buckets from first to last, both included
+            :rtype: list
+        """
+
+        return [label for label in self.labels if first <= label <= last]
+
+
+def time_bucket_counts(day_counts, levels=BUCKET_LEVELS):
+    """
+        Adds up day counts into every requested bucket level
+
+        :param day_counts: table of day (year-month-day), country and artist with the play counts
+        :type day_counts: EncodedCounts
+
+        :param levels: the bucket levels to make
+        :type levels: tuple
+
+        :return: dictionary[level] = TimeBucketCounts
+        :rtype: dict
+    """
+
+    countries = day_counts.outer
+    artists = day_counts.inner
+
+    # the day ids index the day vocabulary
+    days = list(day_counts)
+    day_ids, country_ids, artist_ids, counts = day_counts.rows()
+
+    number_of_countries = max(len(countries), 1)
+    number_of_artists = max(len(artists), 1)
+
+    # ------------ Add the days up for each level
+    results = dict()
+    for level in levels:
+        day_labels = [bucket_label(day, level) for day in days]
+        labels = sorted(set(day_labels))
+        label_index = {label: i for i, label in enumerate(labels)}
+        bucket_of_day = np.array([label_index[label] for label in day_labels], dtype=np.int64)
+
+        keys = (bucket_of_day[day_ids] * number_of_countries + country_ids) * number_of_artists + artist_ids
+        unique_keys, positions = np.unique(keys, return_inverse=True)
+        summed = np.bincount(positions, weights=counts, minlength=len(unique_keys))
+
+        buckets = unique_keys // (number_of_countries * number_of_artists)
+        bucket_pointers = np.searchsorted(buckets, np.arange(len(labels) + 1))
+
+        results[level] = TimeBucketCounts(level, labels, bucket_pointers,
+                                          ((unique_keys // number_of_artists) % number_of_countries).astype(ID_TYPE),
+                                          (unique_keys % number_of_artists).astype(ID_TYPE),
+                                          np.rint(summed).astype(COUNT_TYPE),
+                                          countries, artists)
+
+    return results
@@ -0,0 +1,60 @@
+"""
+    Shared top-k selection for play count dictionaries and arrays.
+
+    Ties are always broken by position: when two keys have the same count, the one that comes first in the dictionary
+    (or has the lower index in the array) ranks higher. This is the same order as taking max() and popping the result
+    over and over, which is what the graph code did before.
+"""
+
+import heapq
+
+import numpy as np
+
+
+def top_k_dict(dictionary, k):
+    """
+        Gets the k keys with the largest values in a dictionary
+
+        :param dictionary: dictionary[key] = count
+        :type dictionary: dict
+
+        :param k: the number of keys to get
+        :type k: int
+
+        :return: the keys ordered from largest to smallest value, fewer than k if the dictionary is smaller
+        :rtype: list
+    """
+
+    # nlargest is stable, so equal values keep the order of the dictionary
+    return heapq.nlargest(k, dictionary, key=dictionary.__getitem__)
+
+
+def top_k_array(values, k):
+    """
+        Gets the indexes of the k largest values in an array
+
+        :param values: 1D array of counts
+        :type values: numpy.ndarray
+
+        :param k: the number of indexes to get
+        :type k: int
+
+        :return: the indexes ordered from largest to smallest value, fewer than k if the array is smaller
+        :rtype: numpy.ndarray
+    """
+
+    values = np.asarray(values)
+    k = min(k, len(values))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    if k < len(values):
+        # find the kth largest value, then keep everything at or above it so ties at the edge are decided by index
+        threshold = values[np.argpartition(values, len(values) - k)[len(values) - k]]
+        candidates = np.flatnonzero(values >= threshold)
+    else:
+        candidates = np.arange(len(values))
+
+    # sort by value from largest to smallest then by index
+    order = np.lexsort((candidates, -values[candidates].astype(np.float64)))
+    return candidates[order[:k]]
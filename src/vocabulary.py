@@ -0,0 +1,555 @@
+"""
+    Dictionary encoding for the last.fm data sets.
+
+    The plays and country_artist dictionaries repeat the same user ids, artist names and country names at every level.
+    This file gives every distinct string a dense integer id that is kept in a shared vocabulary table, so the
+    aggregates can be stored as numpy arrays of ids and counts and joined with integer lookups instead of string
+    hashing.
+
+    An encoded aggregate is a tuple of three arrays of the same length (a row of a sparse table in each position):
+        (outer_ids, inner_ids, counts)
+    sorted by outer id then inner id. For the plays dictionary the outer ids are users and for the country_artist
+    dictionaries they are countries. The inner ids are always artists.
+
+    EncodedCounts holds one such aggregate for every year (or day) together with its vocabularies. It is what the
+    encoded pipeline stores in place of the nested dictionaries, see ingest --encoded in parse_music_data.py.
+"""
+
+from array import array
+
+import numpy as np
+
+ID_TYPE = np.int32
+COUNT_TYPE = np.int64
+
+# the 'share' normalization makes float weights, which are kept as floats instead of being truncated
+WEIGHT_TYPE = np.float64
+
+
+class Vocabulary:
+    """
+        Maps strings to dense integer ids and back
+
+        Ids are given out in the order the strings are first seen, starting at 0.
+    """
+
+    def __init__(self, words=()):
+        self.words = list()
+        self.ids = dict()
+        for word in words:
+            self.id(word)
+
+    def id(self, word):
+        """
+            Gets the id of a word, giving it the next free id if it hasn't been seen yet
+
+            :param word: the string to look up
+            :type word: str
+
+            :return: the id of the word
+            :rtype: int
+        """
+
+        try:
+            return self.ids[word]
+        except KeyError:
+            self.ids[word] = len(self.words)
+            self.words.append(word)
+            return self.ids[word]
+
+    def get(self, word, default=-1):
+        """
+            Gets the id of a word without adding it
+
+            :return: the id of the word or default if it isn't in the vocabulary
+            :rtype: int
+        """
+
+        return self.ids.get(word, default)
+
+    def word(self, word_id):
+        return self.words[word_id]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __getstate__(self):
+        # only the word list is stored, the ids are rebuilt when it is loaded
+        return self.words
+
+    def __setstate__(self, words):
+        self.__init__(words)
+
+
+class EncodedCounts:
+    """
+        Counts of (key, outer, inner) string triples stored as integer ids, e.g. dictionary[year][user_id][artist]
+
+        Rows are added one at a time to flat id buffers. When the buffers are full they are sorted and summed into a
+        run of (key_ids, outer_ids, inner_ids, counts) arrays, and runs of about the same size are merged, so the
+        counts never live in nested dictionaries and adding stays cheap however many rows there are. add() takes the
+        same arguments as add_play() in parse_music_data.py, so a table can be filled by count_plays_rows().
+
+        arrays(key) gives one key's counts in the (outer_ids, inner_ids, counts) form of the rest of this file, and
+        to_dict(key) decodes them for code that needs the strings.
+    """
+
+    def __init__(self, outer=None, inner=None, buffer_size=1 << 20):
+        """
+            :param outer: the vocabulary of the outer strings (users or countries), a new one if None
+            :type outer: Vocabulary
+
+            :param inner: the vocabulary of the inner strings (artists), a new one if None
+            :type inner: Vocabulary
+
+            :param buffer_size: the number of rows added before they are summed into a run
+            :type buffer_size: int
+        """
+
+        self.keys = Vocabulary()
+        self.outer = Vocabulary() if outer is None else outer
+        self.inner = Vocabulary() if inner is None else inner
+        self.buffer_size = buffer_size
+
+        self.runs = list()
+        self._clear_buffers()
+
+    def _clear_buffers(self):
+        self.key_buffer = array('i')
+        self.outer_buffer = array('i')
+        self.inner_buffer = array('i')
+        self.count_buffer = array('q')
+
+    @classmethod
+    def from_encoded(cls, encoded, outer, inner):
+        """
+            Makes a table from arrays that are already encoded, e.g. the results of join_user_country()
+
+            :param encoded: dictionary[key] = (outer_ids, inner_ids, counts) sorted by outer id then inner id with every
+                            pair once, like the functions of this file return them. The counts can be floats.
+            :type encoded: dict
+
+            :param outer: the vocabulary of the outer ids
+            :type outer: Vocabulary
+
+            :param inner: the vocabulary of the inner ids
+            :type inner: Vocabulary
+
+            :rtype: EncodedCounts
+        """
+
+        table = cls(outer, inner)
+        if not encoded:
+            return table
+
+        # the keys get increasing ids in this order, so the arrays put one after the other are already a summed run
+        key_ids = [np.full(len(encoded[key][0]), table.keys.id(key), dtype=ID_TYPE) for key in encoded]
+        table.runs.append((np.concatenate(key_ids),
+                           np.concatenate([encoded[key][0] for key in encoded]).astype(ID_TYPE, copy=False),
+                           np.concatenate([encoded[key][1] for key in encoded]).astype(ID_TYPE, copy=False),
+                           np.concatenate([encoded[key][2] for key in encoded])))
+        return table
+
+    def add(self, key, outer, inner, count=1):
+        self.key_buffer.append(self.keys.id(key))
+        self.outer_buffer.append(self.outer.id(outer))
+        self.inner_buffer.append(self.inner.id(inner))
+        self.count_buffer.append(count)
+
+        if len(self.key_buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+            Sums the buffered rows into a run, merging the last runs while they are about the same size
+        """
+
+        if len(self.key_buffer):
+            self.runs.append(sum_rows(np.frombuffer(self.key_buffer, dtype=ID_TYPE),
+                                      np.frombuffer(self.outer_buffer, dtype=ID_TYPE),
+                                      np.frombuffer(self.inner_buffer, dtype=ID_TYPE),
+                                      np.frombuffer(self.count_buffer, dtype=COUNT_TYPE)))
+            self._clear_buffers()
+
+        # like a binary counter, every row is merged about log(number of runs) times
+        while len(self.runs) > 1 and 2 * len(self.runs[-1][0]) >= len(self.runs[-2][0]):
+            self.runs[-2:] = [merge_runs(self.runs[-2:])]
+
+    def compact(self):
+        """
+            Sums everything that was added into a single run
+        """
+
+        self.flush()
+        if len(self.runs) > 1:
+            self.runs = [merge_runs(self.runs)]
+
+    def merge(self, other):
+        """
+            Adds the counts of another table to this one, e.g. one filled from a later part of the file
+
+            The other table's ids are mapped to this table's vocabularies, with the strings this table hasn't seen
+            added in the other table's order, so merging the tables of a file's byte ranges in file order gives the
+            same ids as reading the file in one pass.
+
+            :type other: EncodedCounts
+        """
+
+        other.compact()
+        self.flush()
+        if not other.runs:
+            return
+
+        key_ids, outer_ids, inner_ids, counts = other.runs[0]
+        key_map = np.array([self.keys.id(key) for key in other.keys], dtype=ID_TYPE)
+        outer_map = np.array([self.outer.id(word) for word in other.outer], dtype=ID_TYPE)
+        inner_map = np.array([self.inner.id(word) for word in other.inner], dtype=ID_TYPE)
+
+        self.runs.append(sum_rows(key_map[key_ids], outer_map[outer_ids], inner_map[inner_ids], counts))
+        self.compact()
+
+    def rows(self):
+        """
+            :return: (key_ids, outer_ids, inner_ids, counts) of everything that was added, every id triple once and
+                     sorted by key, outer then inner id
+            :rtype: tuple
+        """
+
+        self.compact()
+        if not self.runs:
+            return (np.empty(0, dtype=ID_TYPE), np.empty(0, dtype=ID_TYPE), np.empty(0, dtype=ID_TYPE),
+                    np.empty(0, dtype=COUNT_TYPE))
+        return self.runs[0]
+
+    def arrays(self, key):
+        """
+            :return: (outer_ids, inner_ids, counts) of one key, sorted by outer id then inner id
+            :rtype: tuple
+        """
+
+        key_id = self.keys.get(key)
+        if key_id < 0:
+            raise KeyError(key)
+
+        key_ids, outer_ids, inner_ids, counts = self.rows()
+        start, end = np.searchsorted(key_ids, [key_id, key_id + 1])
+        return outer_ids[start:end], inner_ids[start:end], counts[start:end]
+
+    def to_dict(self, key):
+        """
+            :return: dictionary[outer][inner] = count of one key
+            :rtype: dict
+        """
+
+        return decode_nested_dict(self.arrays(key), self.outer, self.inner)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        # the buffers are summed first so only the vocabularies and one run of arrays are stored
+        self.compact()
+        return {'keys': self.keys, 'outer': self.outer, 'inner': self.inner, 'buffer_size': self.buffer_size,
+                'runs': self.runs}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._clear_buffers()
+
+
+def sum_rows(key_ids, outer_ids, inner_ids, counts):
+    """
+        Sorts (key_ids, outer_ids, inner_ids, counts) rows and adds up the counts of rows with the same ids
+
+        :return: (key_ids, outer_ids, inner_ids, counts) with every id triple once, sorted by key, outer then inner id
+        :rtype: tuple
+    """
+
+    order = np.lexsort((inner_ids, outer_ids, key_ids))
+    key_ids, outer_ids, inner_ids, counts = key_ids[order], outer_ids[order], inner_ids[order], counts[order]
+    if len(order) == 0:
+        return key_ids, outer_ids, inner_ids, counts
+
+    # a new triple starts wherever one of the ids changes
+    changed = np.empty(len(order), dtype=bool)
+    changed[0] = True
+    changed[1:] = (key_ids[1:] != key_ids[:-1]) | (outer_ids[1:] != outer_ids[:-1]) | (inner_ids[1:] != inner_ids[:-1])
+    starts = np.flatnonzero(changed)
+
+    return key_ids[starts], outer_ids[starts], inner_ids[starts], np.add.reduceat(counts, starts)
+
+
+def merge_runs(runs):
+    """
+        Merges runs from sum_rows() into one
+
+        :rtype: tuple
+    """
+
+    return sum_rows(*(np.concatenate(column) for column in zip(*runs)))
+
+
+def count_type(counts):
+    """
+        Picks the array type for a collection of counts
+
+        :param counts: the counts, e.g. the values of a country_artist dictionary
+        :type counts: iterable
+
+        :return: WEIGHT_TYPE if any count is a float, otherwise COUNT_TYPE
+        :rtype: type
+    """
+
+    return WEIGHT_TYPE if any(isinstance(count, (float, np.floating)) for count in counts) else COUNT_TYPE
+
+
+def encode_user_country(user_country, users, countries):
+    """
+        Turns the user-country dictionary into an array so the country of a user id is an array lookup
+
+        :param user_country: dictionary[user_id] = country
+        :type user_country: dict
+
+        :param users: the user vocabulary, users not in it are added
+        :type users: Vocabulary
+
+        :param countries: the country vocabulary, countries not in it are added
+        :type countries: Vocabulary
+
+        :return: array where index is a user id and value is the country id, or -1 for users without a country
+        :rtype: numpy.ndarray
+    """
+
+    for user in user_country:
+        users.id(user)
+
+    user_country_ids = np.full(len(users), -1, dtype=ID_TYPE)
+    for user in user_country:
+        user_country_ids[users.get(user)] = countries.id(user_country[user])
+
+    return user_country_ids
+
+
+def encode_plays(plays, users, artists):
+    """
+        Encodes the plays dictionary as (user_ids, artist_ids, counts) arrays for each year
+
+        :param plays: dictionary[year][user_id][artist] = artist_play_count
+        :type plays: dict
+
+        :param users: the user vocabulary, users not in it are added
+        :type users: Vocabulary
+
+        :param artists: the artist vocabulary, artists not in it are added
+        :type artists: Vocabulary
+
+        :return: dictionary[year] = (user_ids, artist_ids, counts)
+        :rtype: dict
+    """
+
+    encoded = dict()
+    for year in plays:
+        encoded[year] = encode_nested_dict(plays[year], users, artists)
+
+    return encoded
+
+
+def encode_plays_table(plays):
+    """
+        Encodes the plays dictionary as an EncodedCounts table of year, user id and artist
+
+        :param plays: dictionary[year][user_id][artist] = artist_play_count
+        :type plays: dict
+
+        :rtype: EncodedCounts
+    """
+
+    users, artists = Vocabulary(), Vocabulary()
+    return EncodedCounts.from_encoded(encode_plays(plays, users, artists), users, artists)
+
+
+def encode_country_artist(country_artist, countries, artists):
+    """
+        Encodes one year's country_artist dictionary as (country_ids, artist_ids, counts) arrays
+
+        :param country_artist: dictionary[country][artist] = artist_play_count
+        :type country_artist: dict
+
+        :return: (country_ids, artist_ids, counts)
+        :rtype: tuple
+    """
+
+    return encode_nested_dict(country_artist, countries, artists)
+
+
+def encode_nested_dict(nested, outer_vocabulary, inner_vocabulary):
+    """
+        Encodes a dictionary[outer][inner] = count as sorted (outer_ids, inner_ids, counts) arrays
+
+        :return: (outer_ids, inner_ids, counts)
+        :rtype: tuple
+    """
+
+    size = sum(len(inner) for inner in nested.values())
+    outer_ids = np.empty(size, dtype=ID_TYPE)
+    inner_ids = np.empty(size, dtype=ID_TYPE)
+    counts = np.empty(size, dtype=count_type(count for inner in nested.values() for count in inner.values()))
+
+    position = 0
+    for outer in nested:
+        outer_id = outer_vocabulary.id(outer)
+        for inner in nested[outer]:
+            outer_ids[position] = outer_id
+            inner_ids[position] = inner_vocabulary.id(inner)
+            counts[position] = nested[outer][inner]
+            position += 1
+
+    order = np.lexsort((inner_ids, outer_ids))
+    return outer_ids[order], inner_ids[order], counts[order]
+
+
+def decode_nested_dict(encoded, outer_vocabulary, inner_vocabulary):
+    """
+        Turns (outer_ids, inner_ids, counts) arrays back into a dictionary[outer][inner] = count
+
+        :return: the nested dictionary with the strings from the vocabularies as keys
+        :rtype: dict
+    """
+
+    outer_ids, inner_ids, counts = encoded
+
+    nested = dict()
+    for outer_id, inner_id, count in zip(outer_ids.tolist(), inner_ids.tolist(), counts.tolist()):
+        outer = outer_vocabulary.word(outer_id)
+        if outer not in nested:
+            nested[outer] = dict()
+        nested[outer][inner_vocabulary.word(inner_id)] = count
+
+    return nested
+
+
+def join_user_country(encoded_plays, user_country_ids, number_of_artists):
+    """
+        Adds up one year's encoded user plays by country
+
+        The join is an array lookup of each user's country id, then the (country, artist) pairs are combined into one
+        integer key and summed with numpy.
+
+        :param encoded_plays: (user_ids, artist_ids, counts) for one year, the counts can also be float weights from
+                              normalize_user_plays()
+        :type encoded_plays: tuple
+
+        :param user_country_ids: array from encode_user_country()
+        :type user_country_ids: numpy.ndarray
+
+        :param number_of_artists: the size of the artist vocabulary
+        :type number_of_artists: int
+
+        :return: (country_ids, artist_ids, counts) sorted by country id then artist id
+        :rtype: tuple
+    """
+
+    user_ids, artist_ids, counts = encoded_plays
+
+    # users that are newer than the user-country table have no country
+    user_country_ids = np.append(user_country_ids, -1)
+    country_ids = user_country_ids[np.minimum(user_ids, len(user_country_ids) - 1)]
+
+    # skip users without a country
+    has_country = country_ids >= 0
+    keys = country_ids[has_country].astype(np.int64) * number_of_artists + artist_ids[has_country]
+
+    unique_keys, positions = np.unique(keys, return_inverse=True)
+    summed = np.bincount(positions, weights=counts[has_country], minlength=len(unique_keys))
+
+    # integer counts stay integers, normalized weights stay floats
+    if np.issubdtype(counts.dtype, np.integer):
+        summed = np.rint(summed).astype(COUNT_TYPE)
+
+    return ((unique_keys // number_of_artists).astype(ID_TYPE),
+            (unique_keys % number_of_artists).astype(ID_TYPE),
+            summed)
+
+
+def distinct_listeners(encoded_plays, user_country_ids, number_of_artists):
+    """
+        Counts the distinct users of every country that played each artist in one year
+
+        The (user, artist) pairs are made unique first, so the triples can be raw rows with repeats as well as the
+        encoded plays dictionary. Then every pair counts once for the user's country.
+
+        :param encoded_plays: (user_ids, artist_ids, counts) for one year, only the pairs with a count above 0 are used
+        :type encoded_plays: tuple
+
+        :param user_country_ids: array from encode_user_country()
+        :type user_country_ids: numpy.ndarray
+
+        :param number_of_artists: the size of the artist vocabulary
+        :type number_of_artists: int
+
+        :return: (country_ids, artist_ids, listeners) sorted by country id then artist id
+        :rtype: tuple
+    """
+
+    user_ids, artist_ids, counts = encoded_plays
+
+    played = counts > 0
+    pairs = np.unique(user_ids[played].astype(np.int64) * number_of_artists + artist_ids[played])
+    unique_users = (pairs // number_of_artists).astype(ID_TYPE)
+    unique_artists = (pairs % number_of_artists).astype(ID_TYPE)
+
+    return join_user_country((unique_users, unique_artists, np.ones(len(pairs), dtype=COUNT_TYPE)),
+                             user_country_ids, number_of_artists)
+
+
+NORMALIZATIONS = ('plays', 'cap', 'share')
+
+
+def normalize_user_plays(encoded_plays, normalization='plays', cap=None):
+    """
+        Limits how much each user can add to the country totals before the plays are joined to countries
+
+        'plays' keeps the raw play counts. 'cap' counts at most cap plays of an artist for each user. 'share' replaces
+        each count with the user's share of their own plays that year, so every user adds up to 1 and one heavy user
+        can't decide a small country's top artists.
+
+        :param encoded_plays: (user_ids, artist_ids, counts) for one year
+        :type encoded_plays: tuple
+
+        :param normalization: one of NORMALIZATIONS
+        :type normalization: str
+
+        :param cap: the most plays counted per user and artist, needed for 'cap'
+        :type cap: int
+
+        :return: (user_ids, artist_ids, weights) to pass to join_user_country()
+        :rtype: tuple
+    """
+
+    user_ids, artist_ids, counts = encoded_plays
+
+    if normalization == 'plays':
+        weights = counts
+    elif normalization == 'cap':
+        if cap is None:
+            raise ValueError("the 'cap' normalization needs a cap")
+        weights = np.minimum(counts, cap)
+    elif normalization == 'share':
+        user_totals = np.bincount(user_ids, weights=counts)
+        weights = counts / user_totals[user_ids]
+    else:
+        raise ValueError('unknown normalization: ' + normalization)
+
+    return user_ids, artist_ids, weights
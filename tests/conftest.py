@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# the modules in src import each other by name, the same as when the scripts are run from src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import paths  # noqa: E402
+import parse_music_data  # noqa: E402
+
+
+@pytest.fixture
+def dictionary_directory(tmp_path, monkeypatch):
+    """
+        Points the dictionary folder at a temporary folder so the tests never touch data/dictionary
+    """
+
+    directory = tmp_path / 'dictionary'
+    directory.mkdir()
+    monkeypatch.setattr(paths, 'DICTIONARY_DIRECTORY', str(directory))
+    monkeypatch.setattr(parse_music_data, 'DICTIONARY_DIRECTORY', str(directory))
+    return directory
@@ -0,0 +1,178 @@
+import os
+import pickle
+
+import pytest
+
+import parse_music_data
+from parse_music_data import (commit_pickles, create_plays_dict, ingest_delta, load_dict_pickle,
+                              load_dict_pickle_or_empty, load_watermarks, recover_pickle_journal, scan_user_track,
+                              store_dict_pickle)
+from paths import dictionary_path
+
+USER_COUNTRY = {'user_1': 'Canada', 'user_2': 'Japan', 'user_3': 'Canada'}
+
+
+def row(user, timestamp, artist):
+    return '\t'.join((user, timestamp, 'mbid', artist, 'mbid', 'Track')) + '\n'
+
+
+ROWS = [row('user_1', '2008-01-01T10:00:00Z', 'Artist A'),
+        row('user_2', '2008-03-02T10:00:00Z', 'Artist B'),
+        row('user_1', '2009-05-03T10:00:00Z', 'Artist A'),
+        row('user_3', '2008-07-04T10:00:00Z', 'Artist A'),
+        row('user_2', '2009-09-05T10:00:00Z', 'Artist C'),
+        row('user_4', '2009-11-06T10:00:00Z', 'Artist B')]
+
+
+def write_rows(file_name, rows, mode='w'):
+    with open(file_name, mode, encoding='utf8') as f:
+        f.write(''.join(rows))
+
+
+def expected_plays(rows):
+    plays = dict()
+    for line in rows:
+        user, timestamp, _, artist = line.split('\t')[:4]
+        parse_music_data.add_play(plays, timestamp.split('-')[0], user, artist)
+    return plays
+
+
+# ------------ Watermarks and the partial last line
+
+
+def test_full_read_stops_before_a_partial_last_line(dictionary_directory, tmp_path):
+    user_track = str(tmp_path / 'user_track.tsv')
+    write_rows(user_track, ROWS[:3] + [ROWS[3][:10]])
+
+    assert create_plays_dict(file_name=user_track) == expected_plays(ROWS[:3])
+    assert load_watermarks()['plays'] == {user_track: len(''.join(ROWS[:3]).encode('utf8'))}
+
+
+def test_delta_reads_the_rest_of_a_partial_line_once(dictionary_directory, tmp_path):
+    user_track = str(tmp_path / 'user_track.tsv')
+    store_dict_pickle('user_country', USER_COUNTRY)
+    write_rows(user_track, ROWS[:3] + [ROWS[3][:10]])
+    create_plays_dict(file_name=user_track)
+    parse_music_data.create_country_artist_dict()
+
+    write_rows(user_track, [ROWS[3][10:]] + ROWS[4:], 'a')
+    delta = ingest_delta(user_track, update_plays=True)
+
+    assert delta == expected_plays(ROWS[3:])
+    assert load_dict_pickle('plays') == expected_plays(ROWS)
+    assert load_dict_pickle('2008_country_artist') == {'Canada': {'Artist A': 2}, 'Japan': {'Artist B': 1}}
+    assert load_dict_pickle('2009_country_artist') == {'Canada': {'Artist A': 1}, 'Japan': {'Artist C': 1}}
+    assert ingest_delta(user_track, update_plays=True) == dict()
+
+
+def test_delta_leaves_the_plays_behind_unless_asked(dictionary_directory, tmp_path):
+    user_track = str(tmp_path / 'user_track.tsv')
+    store_dict_pickle('user_country', USER_COUNTRY)
+    write_rows(user_track, ROWS[:3])
+    create_plays_dict(file_name=user_track)
+    parse_music_data.create_country_artist_dict()
+    first_end = load_watermarks()['plays'][user_track]
+
+    write_rows(user_track, ROWS[3:], 'a')
+    ingest_delta(user_track)
+
+    assert load_dict_pickle('plays') == expected_plays(ROWS[:3])
+    assert load_watermarks()['plays'][user_track] == first_end
+    assert load_dict_pickle('2008_country_artist') == {'Canada': {'Artist A': 2}, 'Japan': {'Artist B': 1}}
+
+    # the plays catch up from their own watermark
+    ingest_delta(user_track, update_plays=True)
+    assert load_dict_pickle('plays') == expected_plays(ROWS)
+    assert load_dict_pickle('2008_country_artist') == {'Canada': {'Artist A': 2}, 'Japan': {'Artist B': 1}}
+
+
+def test_delta_rejects_a_file_that_shrank(dictionary_directory, tmp_path):
+    user_track = str(tmp_path / 'user_track.tsv')
+    store_dict_pickle('user_country', USER_COUNTRY)
+    write_rows(user_track, ROWS)
+    create_plays_dict(file_name=user_track)
+    parse_music_data.create_country_artist_dict()
+
+    write_rows(user_track, ROWS[:2])
+    with pytest.raises(ValueError):
+        ingest_delta(user_track)
+
+
+# ------------ Journal
+
+
+def test_recover_pickle_journal_finishes_an_interrupted_commit(dictionary_directory):
+    store_dict_pickle('kept', {'old': 1})
+    store_dict_pickle('replaced', {'old': 1})
+    store_dict_pickle('removed', {'old': 1})
+
+    # a commit that crashed after its journal was saved and the first file was moved into place
+    with open(dictionary_path('new', '.pkl.pending'), 'wb') as f:
+        pickle.dump({'new': 1}, f)
+    with open(dictionary_path('replaced', '.pkl.pending'), 'wb') as f:
+        pickle.dump({'new': 1}, f)
+    os.replace(dictionary_path('new', '.pkl.pending'), dictionary_path('new'))
+    store_dict_pickle('journal', {'new': True, 'replaced': True, 'removed': False})
+
+    recover_pickle_journal()
+
+    assert load_dict_pickle('new') == {'new': 1}
+    assert load_dict_pickle('replaced') == {'new': 1}
+    assert load_dict_pickle('kept') == {'old': 1}
+    assert not os.path.exists(dictionary_path('removed'))
+    assert not os.path.exists(dictionary_path('journal'))
+    assert sorted(os.listdir(dictionary_directory)) == ['kept.pkl', 'new.pkl', 'replaced.pkl']
+
+
+def test_commit_pickles_leaves_the_old_files_until_the_journal_is_saved(dictionary_directory, monkeypatch):
+    store_dict_pickle('replaced', {'old': 1})
+
+    def crash(file_name, dictionary):
+        raise OSError('crashed before the journal was saved')
+
+    with monkeypatch.context() as patch, pytest.raises(OSError):
+        patch.setattr(parse_music_data, 'store_dict_pickle', crash)
+        commit_pickles({'replaced': {'new': 1}, 'added': {'new': 1}})
+
+    recover_pickle_journal()
+    assert load_dict_pickle('replaced') == {'old': 1}
+    assert load_dict_pickle_or_empty('added') == dict()
+
+
+# ------------ Checkpoints
+
+
+def test_checkpointed_scan_resumes_after_a_crash(dictionary_directory, tmp_path, monkeypatch):
+    user_track = str(tmp_path / 'user_track.tsv')
+    rows = ROWS * 20
+    write_rows(user_track, rows + [ROWS[0][:10]])
+    end = parse_music_data.scan_end(user_track)
+    count_byte_range = parse_music_data.count_byte_range
+    calls = []
+
+    def crash_on_third_range(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise RuntimeError('crashed')
+        return count_byte_range(*args)
+
+    with monkeypatch.context() as patch, pytest.raises(RuntimeError):
+        patch.setattr(parse_music_data, 'count_byte_range', crash_on_third_range)
+        scan_user_track(checkpoint_bytes=200, file_name=user_track, end=end)
+
+    checkpoint = load_dict_pickle('plays_checkpoint')
+    assert 0 < checkpoint['offset'] < end
+
+    plays = scan_user_track(checkpoint_bytes=200, resume=True, file_name=user_track, end=end)
+    assert plays == expected_plays(rows)
+    assert not os.path.exists(dictionary_path('plays_checkpoint'))
+
+
+def test_checkpointed_scan_stops_at_the_end(dictionary_directory, tmp_path):
+    user_track = str(tmp_path / 'user_track.tsv')
+    write_rows(user_track, ROWS + [ROWS[0][:10]])
+
+    # a checkpoint range past the end is clamped to it, so the partial last line isn't counted
+    plays = scan_user_track(checkpoint_bytes=len(ROWS[0]) * 4, file_name=user_track,
+                            end=parse_music_data.scan_end(user_track))
+    assert plays == expected_plays(ROWS)